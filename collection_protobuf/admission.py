@@ -0,0 +1,76 @@
+"""
+Admission control for ServiceView
+
+A Limiter bounds the number of requests in flight.  With a
+target_latency the limit adapts to the observed latency: it grows by
+one request per limit's worth of fast requests and shrinks by backoff
+when a request is slow or fails (AIMD).  The requests that were
+already in flight when the limit shrank do not shrink it again.
+Without a target_latency the limit is fixed.
+
+Requests over the limit are shed instead of queued so that the latency
+of the admitted requests stays bounded.
+"""
+import threading
+import time
+
+
+class Limiter(object):
+    def __init__(self, limit=20, min_limit=1, max_limit=None,
+                 target_latency=None, backoff=0.9):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.__decreased_at = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+        acquire(self) -> bool()
+
+        Admit a request, False if it should be shed
+        """
+        with self.__lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, latency, dropped=False):
+        """
+        release(self, float(), bool()) -> None
+
+        Called when an admitted request is done, dropped is True when
+        the request failed because of the backend
+        """
+        with self.__lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if self.target_latency is None:
+                return
+            if dropped or latency > self.target_latency:
+                # Once per window: a request admitted before the last
+                # decrease saw the same overload
+                now = time.time()
+                if now - latency >= self.__decreased_at:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.__decreased_at = now
+            elif in_flight * 2 >= self.limit:
+                # Only grow the limit while it is being used
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
@@ -0,0 +1,284 @@
+"""
+Item level change notifications
+
+Service.store(), Service.store_bytes() and Service.delete() publish
+the serialized item of every change to a Broker.  Removed items are
+marked as tombstones, see service.tombstone().
+
+The Broker fans the events out to its subscriptions.  Each
+subscription has a bounded queue, a subscriber that can not keep up
+is overflowed and has to re-sync with a delta query.
+
+Long-polling clients keep their subscription between polls through a
+cursor, see Broker.open_cursor().  Cursors that are not polled for
+cursor_ttl seconds are closed.
+
+The Backend carries the events between processes.
+"""
+from abc import ABCMeta, abstractmethod
+import errno
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import Queue
+
+log = logging.getLogger(__name__)
+
+
+class Overflow(Exception):
+    """
+    Raised by Subscription.get() once events have been dropped
+    """
+
+
+class Subscription(object):
+    def __init__(self, broker, maxsize):
+        self.broker = broker
+        self.queue = Queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            if not self.overflowed:
+                log.warning("Subscription {!r} overflowed".format(self))
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """
+        get(self, float()) -> str()
+
+        Return the next event, None if nothing was published within
+        timeout seconds.
+
+        Raise Overflow() when the queue is drained and events have
+        been dropped.
+        """
+        try:
+            if self.overflowed:
+                return self.queue.get_nowait()
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            if self.overflowed:
+                raise Overflow()
+            return None
+
+    def drain(self, timeout, max_events):
+        """
+        drain(self, float(), int()) -> [str()]
+
+        Wait up to timeout seconds for an event and return it along
+        with the events that are already queued
+        """
+        event = self.get(timeout)
+        if event is None:
+            return []
+        events = [event]
+        while len(events) < max_events:
+            try:
+                events.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return events
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Broker(object):
+    def __init__(self, backend=None, maxsize=1000, cursor_ttl=60.0):
+        self.maxsize = maxsize
+        self.cursor_ttl = cursor_ttl
+        self.backend = backend or LocalBackend()
+        self.__subscriptions = set()
+        # cursor id to [subscription, last poll]
+        self.__cursors = {}
+        self.__lock = threading.Lock()
+        self.backend.listen(self._deliver)
+
+    def subscribe(self, maxsize=None):
+        subscription = Subscription(self, maxsize or self.maxsize)
+        with self.__lock:
+            self.__subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__lock:
+            self.__subscriptions.discard(subscription)
+
+    def open_cursor(self, maxsize=None):
+        """
+        open_cursor(self, int()) -> (str(), Subscription())
+
+        Subscribe and keep the subscription under a new cursor id
+        """
+        self.__expire_cursors()
+        subscription = self.subscribe(maxsize)
+        cursor = os.urandom(8).encode("hex")
+        with self.__lock:
+            self.__cursors[cursor] = [subscription, time.time()]
+        return cursor, subscription
+
+    def cursor(self, cursor):
+        """
+        cursor(self, str()) -> Subscription()
+
+        The subscription of cursor, None if it is unknown or expired
+        """
+        self.__expire_cursors()
+        with self.__lock:
+            entry = self.__cursors.get(cursor)
+            if entry is None:
+                return None
+            entry[1] = time.time()
+            return entry[0]
+
+    def close_cursor(self, cursor):
+        with self.__lock:
+            entry = self.__cursors.pop(cursor, None)
+        if entry is not None:
+            entry[0].close()
+
+    def publish(self, event):
+        self.backend.publish(event)
+
+    def close(self):
+        self.backend.close()
+
+    def __expire_cursors(self):
+        expired_at = time.time() - self.cursor_ttl
+        with self.__lock:
+            expired = [cursor for cursor, (_, polled) in self.__cursors.iteritems()
+                       if polled < expired_at]
+        for cursor in expired:
+            self.close_cursor(cursor)
+
+    def _deliver(self, event):
+        with self.__lock:
+            subscriptions = list(self.__subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+
+###================================================================
+### Backends
+###================================================================
+class Backend(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def publish(self, event):
+        """
+        publish(self, str()) -> None
+
+        Send the event to every listener
+        """
+
+    @abstractmethod
+    def listen(self, callback):
+        """
+        listen(self, callable(str())) -> None
+
+        Call callback for every event published to this backend
+        """
+
+    def close(self):
+        pass
+
+
+class LocalBackend(Backend):
+    """
+    Deliver events to the listeners of this process only
+    """
+    def __init__(self):
+        self.callbacks = []
+
+    def publish(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def listen(self, callback):
+        self.callbacks.append(callback)
+
+
+class UnixSocketBackend(Backend):
+    """
+    Deliver events to every process with a socket in directory
+
+    Every process binds a datagram socket in the directory, publish()
+    sends the event to each of them.  Sockets of dead processes are
+    removed when they refuse the event.
+    """
+    _ids = itertools.count()
+    max_event_size = 65536
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(
+            directory, "{0}-{1}.sock".format(os.getpid(), next(self._ids)))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1.0)
+        self.closed = False
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.callbacks = []
+        self.__thread = None
+
+    def publish(self, event):
+        if len(event) > self.max_event_size:
+            log.error("Dropping event of {0} bytes".format(len(event)))
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                self.out.sendto(event, path)
+            except socket.error, e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    self.__remove(path)
+                else:
+                    log.exception("Error publishing to {0}".format(path))
+
+    def listen(self, callback):
+        self.callbacks.append(callback)
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__receive)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def close(self):
+        self.closed = True
+        self.__remove(self.path)
+        self.sock.close()
+        self.out.close()
+
+    def __receive(self):
+        while not self.closed:
+            try:
+                event = self.sock.recv(self.max_event_size)
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            for callback in self.callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    log.exception("Error delivering event")
+
+    def __remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,231 @@
+"""
+Export and import the items of a collection
+
+    collection-protobuf export myapp.services.UserService -o users.pb.gz
+    collection-protobuf import myapp.services.UserService users.pb.gz \\
+        --workers 4 --checkpoint users.checkpoint
+
+The service class is instantiated without arguments.  Exports are a
+stream of length delimited item messages, optionally compressed with
+gzip or bz2.  Imports read such a stream in batches and store them
+with Service.store_many() on a pool of worker threads.
+
+With --checkpoint the number of imported items is recorded after each
+batch, running the same import again resumes after them.  Services
+that buffer writes and answer 202 Accepted, like WriteBehindService,
+are flushed before the checkpoint moves past a batch, and the service
+is closed when the command is done.
+"""
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from collection_protobuf.service import Error
+from collection_protobuf.utils import delimited, import_string, iter_delimited
+import argparse
+import bz2
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+COMPRESSIONS = {
+    "none": open,
+    "gzip": gzip.open,
+    "bz2": bz2.BZ2File,
+}
+
+
+class Progress(object):
+    """
+    Report the number of items processed every interval seconds
+    """
+    def __init__(self, verb, interval=5.0, stream=sys.stderr):
+        self.verb = verb
+        self.interval = interval
+        self.stream = stream
+        self.count = 0
+        self.start = self.reported = time.time()
+
+    def add(self, count):
+        self.count += count
+        now = time.time()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        self.stream.write("{0} {1} items in {2:.1f}s ({3:.0f}/s)\n".format(
+            self.verb, self.count, elapsed, self.count / max(elapsed, 1e-6)))
+
+
+def open_input(path):
+    """
+    Open path, uncompressing gzip and bz2 files
+    """
+    with open(path, "rb") as f:
+        magic = f.read(3)
+    if magic[:2] == "\x1f\x8b":
+        return gzip.open(path, "rb")
+    if magic == "BZh":
+        return bz2.BZ2File(path, "rb")
+    return open(path, "rb")
+
+
+def export(service, stream, progress):
+    for item in service.iter_items():
+        stream.write(delimited(item.SerializeToString()))
+        progress.add(1)
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return json.load(f)["items"]
+
+    def save(self, items):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"items": items}, f)
+        os.rename(tmp, self.path)
+
+
+def batches(stream, skip, size):
+    """
+    Yield lists of serialized items after skipping skip items
+    """
+    items = iter_delimited(stream)
+    for _ in xrange(skip):
+        if next(items, None) is None:
+            return
+
+    batch = []
+    for byte_string in items:
+        batch.append(byte_string)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def store_batch(service, batch):
+    item = service._resource_class()().collection.items.add()
+    collections = []
+    for byte_string in batch:
+        try:
+            item.ParseFromString(byte_string)
+        except Exception, e:
+            raise Error(400, title="Error parsing item", code="400",
+                        message=unicode(e))
+        collection = service._resource_class()().collection
+        service._item_template(item, collection.template)
+        collections.append(collection)
+
+    result = service.store_many(collections)
+    if result.status >= 400:
+        error = result.resource.collection.error
+        raise Error(result.status, title=error.title, code=error.code,
+                    message=error.message)
+    return len(batch)
+
+
+def load(service, stream, checkpoint, progress, batch_size=1000, workers=4):
+    done = checkpoint.load()
+    if done:
+        log.info("Resuming after {0} items".format(done))
+
+    pool = ThreadPool(workers)
+    pending = deque()
+    flush = getattr(service, "flush", None)
+
+    def finish(done):
+        # Batches finish in order, the checkpoint only moves past a
+        # batch once every batch before it is stored
+        count = pending.popleft().get()
+        # 202 Accepted only buffered the batch, the checkpoint may only
+        # move past it once it is saved
+        if flush is not None:
+            flush()
+        checkpoint.save(done + count)
+        progress.add(count)
+        return done + count
+
+    try:
+        for batch in batches(stream, done, batch_size):
+            pending.append(pool.apply_async(store_batch, (service, batch)))
+            # Bound the batches read ahead of the workers
+            if len(pending) >= workers * 2:
+                done = finish(done)
+        while pending:
+            done = finish(done)
+    finally:
+        pool.terminate()
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="collection-protobuf",
+        description="Export and import the items of a collection")
+    commands = parser.add_subparsers(dest="command")
+
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("service", help="dotted path of the Service class")
+    export_parser.add_argument("-o", "--output", help="output file, stdout by default")
+    export_parser.add_argument("--compress", choices=sorted(COMPRESSIONS),
+                               default="none", help="compress the output file")
+
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("service", help="dotted path of the Service class")
+    import_parser.add_argument("input", help="exported file")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--workers", type=int, default=4)
+    import_parser.add_argument("--checkpoint",
+                               help="file recording the imported items")
+
+    for command in (export_parser, import_parser):
+        command.add_argument("--progress", type=float, default=5.0,
+                             help="seconds between progress reports")
+
+    args = parser.parse_args(argv)
+    if args.command == "export" and args.output is None and args.compress != "none":
+        parser.error("--compress requires --output")
+    service = import_string(args.service)()
+
+    try:
+        if args.command == "export":
+            progress = Progress("exported", args.progress)
+            if args.output is None:
+                export(service, sys.stdout, progress)
+            else:
+                with COMPRESSIONS[args.compress](args.output, "wb") as stream:
+                    export(service, stream, progress)
+        else:
+            progress = Progress("imported", args.progress)
+            with open_input(args.input) as stream:
+                load(service, stream, Checkpoint(args.checkpoint), progress,
+                     batch_size=args.batch_size, workers=args.workers)
+    except Error, e:
+        sys.stderr.write("{0} {1}: {2}\n".format(e.status, e.title, e.message))
+        return 1
+    finally:
+        close = getattr(service, "close", None)
+        if close is not None:
+            close()
+    progress.report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
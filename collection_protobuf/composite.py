@@ -0,0 +1,246 @@
+"""
+Query several collections with one call
+
+    composite = CompositeService({"users": UserService(),
+                                  "orders": OrderService()},
+                                 timeout=0.5, cache=LocalCache(ttl=5))
+
+    for name, status, byte_string in composite.query([
+            SubQuery("me", "users", ("42",)),
+            SubQuery("recent", "orders", timeout=0.2)]):
+        ...
+
+The sub-queries run in parallel on a thread pool and their results are
+yielded as soon as each is done, a slow collection does not hold back
+the others.  A sub-query that runs out of time is answered with a 504
+while the service is told to stop through the deadline of its query.
+A sub-query whose arguments do not fit the _query() of its service is
+answered with a 400.
+
+Successful results are cached by the services, arguments and keyword
+arguments of the sub-query when a cache is given.  The cache only
+expires entries, writes to the services do not invalidate it.
+
+envelope() frames the results for a response, each entry is length
+delimited and holds the length delimited name, the varint status and
+the serialized Resource.  iter_envelope() reads them back.
+"""
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from collection_protobuf.service import (Deadline, DeadlineExceeded, Error,
+                                         PARTIAL_REL)
+from collection_protobuf.utils import (decode_varint, delimited, encode_varint,
+                                       iter_delimited)
+import Queue
+import inspect
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SubQuery(object):
+    def __init__(self, name, service, args=(), kwargs=None, timeout=None,
+                 nocache=False):
+        """
+        name labels the result, service is the registered name of the
+        service to query with args and kwargs
+        """
+        self.name = name
+        self.service = service
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.timeout = timeout
+        self.nocache = nocache
+
+    def cache_key(self):
+        return repr((self.service, self.args, sorted(self.kwargs.items())))
+
+
+class LocalCache(object):
+    """
+    A LRU cache of serialized results that expire after ttl seconds
+    """
+    def __init__(self, size=1000, ttl=1.0):
+        self.size = size
+        self.ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.__entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.time() + self.ttl, value)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+        return True
+
+
+class CompositeService(object):
+    def __init__(self, services, workers=8, timeout=None, cache=None):
+        """
+        services is a dict of name to Service(), timeout is the
+        default seconds a sub-query may take, cache a LocalCache() or
+        shmcache.SharedMemoryCache()
+        """
+        self.services = dict(services)
+        self.timeout = timeout
+        self.cache = cache
+        self.__pool = ThreadPool(workers)
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def query(self, subqueries, deadline=None):
+        """
+        query(self, [SubQuery()], Deadline()) -> iterator((str(), int(), str()))
+
+        Run the sub-queries in parallel, yield the name, status and
+        serialized Resource of each in the order they finish.  deadline
+        bounds the whole call.
+        """
+        names = [sub.name for sub in subqueries]
+        if len(set(names)) != len(names):
+            raise Error(400,
+                        title="Bad Request",
+                        code="400",
+                        message="sub-query names must be unique")
+
+        done = Queue.Queue()
+        waiting = {}
+        ready = []
+        for sub in subqueries:
+            if sub.service not in self.services:
+                ready.append((sub.name, 404, ""))
+                continue
+            if not self.__valid_arguments(sub):
+                ready.append(self.__error_entry(sub, Error(
+                    400,
+                    title="Bad Request",
+                    code="400",
+                    message="invalid arguments for {0!r}".format(sub.service))))
+                continue
+            cached = self.__cached(sub)
+            if cached is not None:
+                ready.append((sub.name, 200, cached))
+                continue
+            sub_deadline = self.__deadline(sub, deadline)
+            waiting[sub.name] = (sub, sub_deadline)
+            self.__pool.apply_async(self.__run, (sub, sub_deadline),
+                                    callback=done.put)
+
+        for entry in ready:
+            yield entry
+        while waiting:
+            dues = [d.at for _, d in waiting.itervalues() if d is not None]
+            due = min(dues) if dues else None
+            try:
+                name, status, byte_string = done.get(
+                    timeout=None if due is None else max(0, due - time.time()))
+            except Queue.Empty:
+                for expired in self.__expired(waiting):
+                    yield expired
+                continue
+            if waiting.pop(name, None) is not None:
+                yield name, status, byte_string
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __deadline(self, sub, deadline):
+        timeout = sub.timeout if sub.timeout is not None else self.timeout
+        if timeout is None:
+            return deadline
+        sub_deadline = Deadline(timeout)
+        if deadline is not None and deadline.at < sub_deadline.at:
+            return deadline
+        return sub_deadline
+
+    def __expired(self, waiting):
+        # The services stop at the deadline too, their late results
+        # are dropped
+        now = time.time()
+        for name, (sub, deadline) in waiting.items():
+            if deadline is not None and deadline.at <= now:
+                del waiting[name]
+                yield self.__error_entry(sub, DeadlineExceeded())
+
+    def __error_entry(self, sub, error):
+        resource = self.services[sub.service]._resource_class()()
+        error._set_error(resource)
+        return sub.name, error.status, resource.SerializeToString()
+
+    def __valid_arguments(self, sub):
+        # The arguments come from the client, they must fit _query()
+        # rather than fail inside the service with a 500
+        _query = getattr(self.services[sub.service], "_query", None)
+        if _query is None:
+            return True
+        kwargs = dict((k, v) for k, v in sub.kwargs.iteritems() if k != "since")
+        try:
+            inspect.getcallargs(_query, *sub.args, **kwargs)
+        except TypeError:
+            return False
+        return True
+
+    def __cached(self, sub):
+        if self.cache is None or sub.nocache:
+            return None
+        return self.cache.get(sub.cache_key())
+
+    def __run(self, sub, deadline):
+        service = self.services[sub.service]
+        try:
+            result = service.query(*sub.args, deadline=deadline, **sub.kwargs)
+            try:
+                byte_string = result.serialize()
+                partial = any(link.rel == PARTIAL_REL
+                              for link in result.head.collection.links)
+            finally:
+                result.release()
+        except Exception:
+            log.exception("Error running sub-query {0!r}".format(sub.name))
+            return sub.name, 500, ""
+
+        if (self.cache is not None and result.status == 200 and not partial
+            and sub.kwargs.get("since") is None):
+            self.cache.set(sub.cache_key(), byte_string)
+        return sub.name, result.status, byte_string
+
+
+def envelope(entries):
+    """
+    envelope(iterator((str(), int(), str()))) -> iterator(str())
+
+    Frame the name, status and serialized Resource of each entry
+    """
+    for name, status, byte_string in entries:
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        yield delimited(delimited(name) + encode_varint(status) + byte_string)
+
+
+def iter_envelope(stream):
+    """
+    iter_envelope(file()) -> iterator((str(), int(), str()))
+
+    Read the entries of an envelope
+    """
+    for entry in iter_delimited(stream):
+        size, pos = decode_varint(entry)
+        name = entry[pos:pos + size]
+        status, pos = decode_varint(entry, pos + size)
+        yield name, status, entry[pos:]
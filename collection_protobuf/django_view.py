@@ -1,12 +1,40 @@
 from django.views.generic.base import View
 from django import http
+from collection_protobuf.service import (CHANGES_REL, Deadline, Error, Result,
+                                        deadline_scope, item_hook_scope)
+# composite, filters and changes are imported by the views using them,
+# composite pulls in multiprocessing and changes socket
+from collection_protobuf.utils import delimited
 from abc import ABCMeta, abstractproperty, abstractmethod
+from urllib import urlencode
+from urlparse import parse_qsl
+import base64
+import json
+import time
 
 
 class ServiceView(View):
     __metaclass__ = ABCMeta
     content_type = "application/vnd.collection+protobuf"
 
+    # admission.Limiter() budgets for reads and writes, None to admit
+    # every request
+    read_limiter = None
+    write_limiter = None
+    read_methods = ("get", "head", "options")
+    # Seconds a shed client should wait before retrying
+    retry_after = 1
+    # The serialized 503 resource of the view class, built on the first
+    # shed request
+    _shed_body = None
+    # Seconds a request may take when the client does not send an
+    # X-Request-Timeout header, None for no deadline
+    timeout = None
+    # Query parameters that are not filters, see self._filters()
+    reserved_params = ("since",)
+    # A profiling.Profiler() deciding which requests are profiled
+    profiler = None
+
     @abstractproperty
     def _service(self):
         pass
@@ -29,21 +57,103 @@ class ServiceView(View):
 
     @property
     def service(self):
-        s = self._service
-        s.item_hooks.add(self._item)
-        return s
-        
+        return self._service
+
     def _item(self, item, model):
         item.href = self._item_href(item, model)
 
     def _resource(self, resource):
         resource.collection.href = self._href
+        for link in resource.collection.links:
+            if link.rel == CHANGES_REL:
+                link.href = self._changes_href(link.href)
+        for query in resource.collection.queries:
+            if not query.href:
+                query.href = self._href
+
+    def _changes(self, request, token, *args, **kwargs):
+        """
+        Return the changes of the collection since token
+        """
+        return self.service.query(since=token)
+
+    def _filters(self, request):
+        """
+        Return the filters.Filter() list of the query parameters,
+        raise a service.Error() for a parameter that is not advertised
+        in the collection.queries of the service
+        """
+        from collection_protobuf.filters import parse_filters
+        resource = self._service._resource_class()()
+        self._service._queries(resource.collection)
+        params = [(name, value) for name, value in request.GET.items()
+                  if name not in self.reserved_params]
+        return parse_filters(params, resource.collection.queries)
+
+    def _changes_href(self, token):
+        return "{0}?{1}".format(self._href, urlencode({"since": token}))
+
+    def dispatch(self, request, *args, **kwargs):
+        profiler = self.profiler
+        if profiler is None or not profiler.sample(
+                profiler.requested(header(request, profiler.header))):
+            return self.__dispatch(request, *args, **kwargs)
+
+        label = "{0} {1}".format(request.method, request.path)
+        with profiler.profile(label) as profile:
+            response = self.__dispatch(request, *args, **kwargs)
+        response['x-profile-id'] = profile.id
+        return response
+
+    def __dispatch(self, request, *args, **kwargs):
+        # The service is shared by the requests, the hook of this
+        # request only applies to the items added for it
+        with deadline_scope(self._deadline(request)), item_hook_scope(self._item):
+            return self.__admit(request, *args, **kwargs)
+
+    def _deadline(self, request):
+        timeout = request_timeout(request)
+        if timeout is None:
+            timeout = self.timeout
+        elif self.timeout is not None:
+            timeout = min(timeout, self.timeout)
+        if timeout is None:
+            return None
+        return Deadline(timeout)
+
+    def __admit(self, request, *args, **kwargs):
+        if request.method.lower() in self.read_methods:
+            limiter = self.read_limiter
+        else:
+            limiter = self.write_limiter
+
+        if limiter is None:
+            return super(ServiceView, self).dispatch(request, *args, **kwargs)
+        if not limiter.acquire():
+            return self.render_shed()
+
+        start = time.time()
+        dropped = True
+        try:
+            response = super(ServiceView, self).dispatch(request, *args, **kwargs)
+            dropped = response.status_code >= 500
+            return response
+        finally:
+            limiter.release(time.time() - start, dropped)
 
     ###================================================================
     ### Render methods
     ###================================================================
     def get(self, request, *args, **kwargs):
-        result = self._query(request, *args, **kwargs)
+        token = since(request)
+        try:
+            if token is None:
+                result = self._query(request, *args, **kwargs)
+            else:
+                result = self._changes(request, token, *args, **kwargs)
+        except Error, e:
+            # e.g. invalid filters
+            result = self._error_result(e)
         return self.render(
             accept(request),
             result)
@@ -52,6 +162,8 @@ class ServiceView(View):
         result = self._query(request, *args, **kwargs)
         
         if result.status == 200:
+            # Only the status of the query is needed
+            result.release()
             result = self.service.store_bytes(request.body)
 
         return self.render(
@@ -76,24 +188,56 @@ class ServiceView(View):
     def render_pb(self, result):
         full_content_type = self.content_type + "; profile=" + self._profile_href
         return http.HttpResponse(
-            result.resource.SerializeToString(),
+            result.serialize(),
             content_type=full_content_type,
             status=result.status)
 
+    def render_shed(self):
+        cls = type(self)
+        # Not inherited, subclasses may render another resource
+        if cls.__dict__.get("_shed_body") is None:
+            resource = self._service._resource_pb()
+            error = resource.collection.error
+            error.title = "Service Unavailable"
+            error.code = "503"
+            error.message = "The server is overloaded, please retry later."
+            self._resource(resource)
+            cls._shed_body = resource.SerializeToString()
+
+        response = http.HttpResponse(
+            cls._shed_body,
+            content_type=self.content_type + "; profile=" + self._profile_href,
+            status=503)
+        response['retry-after'] = str(self.retry_after)
+        return response
+
+    def _error_result(self, error):
+        resource = self._service._resource_class()()
+        error._set_error(resource)
+        return Result(error.status, resource)
+
     def render_no_content(self):
         return http.HttpResponse(
             '',
             status=204)
 
     def render(self, accept, result):
-        if result.status == 204:
-            return self.render_no_content()
+        try:
+            if result.status == 204:
+                return self.render_no_content()
+            if result.head is None:
+                # Calls without a resource, like delete(), fail with
+                # a bare status
+                return http.HttpResponse('', status=result.status)
 
-        self._resource(result.resource)
+            self._resource(result.head)
 
-        response = self.select_response(accept, result)
-        response['link'] = '<{0}>; rel="profile"'.format(self._profile_href)
-        return response
+            response = self.select_response(accept, result)
+            response['link'] = '<{0}>; rel="profile"'.format(self._profile_href)
+            return response
+        finally:
+            # The response holds the serialized resource
+            result.release()
 
     def select_response(self, accept, result):
         if accept_matches(accept, "text/plain"):
@@ -102,9 +246,200 @@ class ServiceView(View):
             return self.render_pb(result)
 
 
+class ChangesView(View):
+    """
+    Stream the item changes published to a changes.Broker()
+
+    Clients that accept text/event-stream get Server-Sent Events with
+    the base64 encoded items, everyone else long-polls and gets the
+    length delimited items.
+
+    Each long-poll response has an X-Changes-Cursor header, sending it
+    back with the next poll (header or ?cursor=) continues from the
+    events published since the previous poll.  An unknown or expired
+    cursor, or one that overflowed, gets a 410 Gone: the client has
+    to re-sync with a delta query.
+    """
+    __metaclass__ = ABCMeta
+    content_type = "application/vnd.collection+protobuf; delimited=true"
+    poll_timeout = 30
+    max_events = 100
+    queue_size = 100
+
+    @abstractproperty
+    def _broker(self):
+        pass
+
+    def get(self, request, *args, **kwargs):
+        if accept_matches(accept(request), "text/event-stream"):
+            response = http.StreamingHttpResponse(
+                self.__event_stream(),
+                content_type="text/event-stream")
+            response['cache-control'] = 'no-cache'
+            return response
+
+        from collection_protobuf.changes import Overflow
+        broker = self._broker
+        cursor = request.GET.get("cursor", header(request, "X-Changes-Cursor"))
+        if cursor is None:
+            cursor, subscription = broker.open_cursor(self.queue_size)
+        else:
+            subscription = broker.cursor(cursor)
+            if subscription is None:
+                return http.HttpResponse('', status=410)
+
+        try:
+            events = subscription.drain(self.poll_timeout, self.max_events)
+        except Overflow:
+            broker.close_cursor(cursor)
+            return http.HttpResponse('', status=410)
+
+        if not events:
+            response = http.HttpResponse('', status=204)
+        else:
+            response = http.HttpResponse(
+                ''.join(delimited(event) for event in events),
+                content_type=self.content_type)
+        response['x-changes-cursor'] = cursor
+        return response
+
+    def __event_stream(self):
+        # Subscribe once the response is iterated so that a response
+        # that is never sent does not leave a subscription behind
+        from collection_protobuf.changes import Overflow
+        with self._broker.subscribe(self.queue_size) as subscription:
+            while True:
+                try:
+                    event = subscription.get(self.poll_timeout)
+                except Overflow:
+                    yield "event: overflow\ndata:\n\n"
+                    return
+                if event is None:
+                    # keep the connection alive
+                    yield ":\n\n"
+                else:
+                    yield "data: {0}\n\n".format(base64.b64encode(event))
+
+
+class CompositeView(View):
+    """
+    Stream the results of several collections of a
+    composite.CompositeService() as one envelope
+
+        GET /dashboard?q=me:users?key=42&q=recent:orders?timeout=0.2
+
+    Each q parameter is name:service followed by the urlencoded keyword
+    arguments of the query, timeout and nocache set the timeout and
+    caching of the sub-query.  The X-Request-Timeout header bounds the
+    whole request.
+    """
+    __metaclass__ = ABCMeta
+    content_type = "application/vnd.collection+protobuf; envelope=true"
+
+    @abstractproperty
+    def _composite(self):
+        pass
+
+    def get(self, request, *args, **kwargs):
+        from collection_protobuf.composite import envelope
+        try:
+            subqueries = [subquery(q) for q in request.GET.getlist("q")]
+        except ValueError:
+            return http.HttpResponse('', status=400)
+        names = [sub.name for sub in subqueries]
+        if len(set(names)) != len(names):
+            return http.HttpResponse('', status=400)
+
+        timeout = request_timeout(request)
+        deadline = None if timeout is None else Deadline(timeout)
+        return http.StreamingHttpResponse(
+            envelope(self._composite.query(subqueries, deadline)),
+            content_type=self.content_type)
+
+
+class ProfileView(View):
+    """
+    Show the profiles kept by a profiling.RingBufferSink()
+
+    Lists the reports as JSON, ?id= shows the stats of one profile as
+    text.  Do not expose this view publicly.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractproperty
+    def _sink(self):
+        pass
+
+    def get(self, request, *args, **kwargs):
+        reports = self._sink.reports()
+        profile_id = request.GET.get("id")
+        if profile_id is None:
+            return http.HttpResponse(
+                json.dumps(reports, indent=2),
+                content_type="application/json")
+
+        for report in reports:
+            if report["id"] == profile_id:
+                phases = "".join("{0:<12} {1:10.3f}ms\n".format(name, seconds * 1000)
+                                 for name, seconds in sorted(report["phases"].items()))
+                allocations = "\n".join(report["allocations"] or [])
+                return http.HttpResponse(
+                    "{0} {1:.3f}ms\n\n{2}\n{3}\n{4}".format(
+                        report["label"], report["elapsed"] * 1000,
+                        phases, report["stats"], allocations),
+                    content_type="text/plain")
+        return http.HttpResponse('', status=404)
+
+
 def accept_matches(accept, media_type):
     # TODO: add better accept handling
     return accept == media_type
 
 def accept(request):
     return request.META.get("HTTP_ACCEPT", "")
+
+def header(request, name):
+    """
+    The value of the HTTP header name, None if it is missing
+    """
+    if name is None:
+        return None
+    return request.META.get("HTTP_" + name.upper().replace("-", "_"))
+
+def subquery(value):
+    """
+    Parse a name:service?key=value sub-query of CompositeView, raise
+    ValueError when it is malformed
+    """
+    from collection_protobuf.composite import SubQuery
+    target, _, query = value.partition("?")
+    name, _, service = target.partition(":")
+    if not name or not service:
+        raise ValueError("malformed sub-query {0!r}".format(value))
+    kwargs = dict(parse_qsl(query))
+    kwargs.pop("deadline", None)
+    timeout = kwargs.pop("timeout", None)
+    nocache = kwargs.pop("nocache", "") not in ("", "0", "false")
+    return SubQuery(name, service,
+                    kwargs=kwargs,
+                    timeout=None if timeout is None else float(timeout),
+                    nocache=nocache)
+
+def request_timeout(request):
+    """
+    The seconds the client is willing to wait from the
+    X-Request-Timeout header
+    """
+    try:
+        return float(request.META["HTTP_X_REQUEST_TIMEOUT"])
+    except (KeyError, ValueError):
+        return None
+
+def since(request):
+    """
+    The changes token from the `since` query parameter or the
+    X-Collection-Since header
+    """
+    return request.GET.get(
+        "since",
+        request.META.get("HTTP_X_COLLECTION_SINCE"))
@@ -0,0 +1,325 @@
+"""
+Declarative query filters and an in-memory indexed service
+
+A filter compares a field of the items to a value.  The fields and
+operators a service supports are advertised in collection.queries as
+the DataField names of a "search" query:
+
+    pb.key          pb.key equals the value
+    pb.age__gte     pb.age is greater than or equal to the value
+
+The operators are eq (no suffix), lt, lte, gt and gte.
+
+    class UserService(IndexedService):
+        _ResourcePB = "myapp.users_pb2.UserResource"
+        indexes = [HashIndex("pb.email"), SortedIndex("pb.age")]
+
+    service.query(filters=[Filter("pb.age", "gte", "18")])
+
+IndexedService keeps its values in memory and answers filters from
+hash and sorted indexes on item fields, the fields are read from the
+items rendered by self._item().  Filter values are converted to the
+type of the field.
+"""
+from abc import abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collection_protobuf.service import Service, Error
+from collection_protobuf.utils import append_msg
+import threading
+
+SEARCH_REL = "search"
+OPERATORS = ("eq", "lt", "lte", "gt", "gte")
+SEPARATOR = "__"
+
+
+class Filter(object):
+    def __init__(self, field, op, value):
+        if op not in OPERATORS:
+            raise ValueError("unknown operator {0!r}".format(op))
+        self.field = field
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def parse(cls, name, value):
+        """
+        parse(cls, str(), str()) -> Filter()
+
+        The filter of a DataField name and value
+        """
+        field, _, op = name.rpartition(SEPARATOR)
+        if not field or op not in OPERATORS:
+            field, op = name, "eq"
+        return cls(field, op, value)
+
+    @property
+    def name(self):
+        return filter_name(self.field, self.op)
+
+    def __eq__(self, other):
+        return (isinstance(other, Filter)
+                and (self.field, self.op, self.value) == (other.field, other.op, other.value))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Filter({0!r}, {1!r}, {2!r})".format(self.field, self.op, self.value)
+
+
+def filter_name(field, op):
+    if op == "eq":
+        return field
+    return field + SEPARATOR + op
+
+
+def parse_filters(params, queries):
+    """
+    parse_filters(iterator((str(), str())), [Query()]) -> [Filter()]
+
+    Parse the name, value pairs of params into filters, raise a
+    service.Error() when a name is not advertised by the search
+    queries
+    """
+    names = set(data.name
+                for query in queries if query.rel == SEARCH_REL
+                for data in query.data)
+    filters = []
+    for name, value in params:
+        if name not in names:
+            raise Error(400,
+                        title="Bad Request",
+                        code="400",
+                        message="unknown filter {0!r}".format(name))
+        filters.append(Filter.parse(name, value))
+    return filters
+
+
+###================================================================
+### Indexes
+###================================================================
+class HashIndex(object):
+    """
+    Answers equality filters on field
+    """
+    operators = ("eq",)
+
+    def __init__(self, field):
+        self.field = field
+        self.__keys = {}
+
+    def add(self, key, value):
+        self.__keys.setdefault(value, OrderedDict())[key] = None
+
+    def remove(self, key, value):
+        keys = self.__keys.get(value)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self.__keys[value]
+
+    def find(self, op, value):
+        """
+        find(self, str(), object()) -> [str()]
+
+        The keys of the values matching the filter
+        """
+        return list(self.__keys.get(value, ()))
+
+
+class SortedIndex(object):
+    """
+    Answers equality and range filters on field, keys are returned in
+    the order of the field
+    """
+    operators = OPERATORS
+
+    def __init__(self, field):
+        self.field = field
+        self.__values = []
+        self.__keys = []
+
+    def add(self, key, value):
+        i = bisect_right(self.__values, value)
+        self.__values.insert(i, value)
+        self.__keys.insert(i, key)
+
+    def remove(self, key, value):
+        i = bisect_left(self.__values, value)
+        while i < len(self.__values) and self.__values[i] == value:
+            if self.__keys[i] == key:
+                del self.__values[i]
+                del self.__keys[i]
+                return
+            i += 1
+
+    def find(self, op, value):
+        start, stop = 0, len(self.__values)
+        if op in ("eq", "gte"):
+            start = bisect_left(self.__values, value)
+        elif op == "gt":
+            start = bisect_right(self.__values, value)
+        if op in ("eq", "lte"):
+            stop = bisect_right(self.__values, value)
+        elif op == "lt":
+            stop = bisect_left(self.__values, value)
+        return self.__keys[start:stop]
+
+
+class IndexedService(Service):
+    # The HashIndex() and SortedIndex() instances of the item fields,
+    # a field may have one of each
+    indexes = ()
+
+    def __init__(self, *args, **kwargs):
+        super(IndexedService, self).__init__(*args, **kwargs)
+        self.__values = OrderedDict()
+        self.__lock = threading.Lock()
+        # Each instance gets its own copy of the declared indexes
+        self.__indexes = [type(index)(index.field) for index in self.indexes]
+
+    ###================================================================
+    ### Hooks
+    ###================================================================
+    @abstractmethod
+    def _value_key(self, value):
+        """
+        _value_key(self, value()) -> str()
+
+        The key values are stored under
+        """
+
+    @abstractmethod
+    def _delete_key(self, *args, **kwargs):
+        """
+        _delete_key(self, *args, **kwargs) -> str()
+
+        The key of the value removed by delete()
+        """
+
+    ###================================================================
+    ### Service methods
+    ###================================================================
+    def _query(self, key=None, filters=()):
+        with self.__lock:
+            if key is not None:
+                if key in self.__values:
+                    return [self.__values[key]]
+                return None
+            if not filters:
+                return self.__values.values()
+            return [self.__values[k] for k in self.__find(filters)]
+
+    def _queries(self, collection):
+        query = append_msg(collection.queries, rel=SEARCH_REL, href="",
+                           name="filter")
+        for index in self.__indexes:
+            for op in index.operators:
+                name = filter_name(index.field, op)
+                if not any(data.name == name for data in query.data):
+                    append_msg(query.data, name=name)
+
+    def _save(self, value):
+        key = self._value_key(value)
+        fields = self.__fields(value)
+        with self.__lock:
+            exists = key in self.__values
+            if exists:
+                self.__unindex(key, self.__values[key])
+            self.__values[key] = value
+            for index in self.__indexes:
+                index.add(key, fields[index.field])
+        return 200 if exists else 201
+
+    def _delete(self, *args, **kwargs):
+        key = self._delete_key(*args, **kwargs)
+        with self.__lock:
+            if key not in self.__values:
+                return False
+            self.__unindex(key, self.__values.pop(key))
+        return True
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __find(self, filters):
+        found = None
+        for f in filters:
+            index = self.__index(f)
+            keys = index.find(f.op, self.__convert(index.field, f.value))
+            if found is None:
+                found = keys
+            else:
+                matching = set(keys)
+                found = [k for k in found if k in matching]
+            if not found:
+                break
+        return found
+
+    def __index(self, f):
+        for index in self.__indexes:
+            if index.field == f.field and f.op in index.operators:
+                return index
+        raise Error(400,
+                    title="Bad Request",
+                    code="400",
+                    message="no index for filter {0!r}".format(f.name))
+
+    def __unindex(self, key, value):
+        fields = self.__fields(value)
+        for index in self.__indexes:
+            index.remove(key, fields[index.field])
+
+    def __fields(self, value):
+        item = self._resource_class()().collection.items.add()
+        self._item(item, value)
+        return dict((index.field, _get_field(item, index.field))
+                    for index in self.__indexes)
+
+    def __convert(self, field, value):
+        if not isinstance(value, basestring):
+            return value
+        descriptor = _field_descriptor(
+            self._resource_class()().collection.items.add(), field)
+        try:
+            return _CONVERTERS.get(descriptor.cpp_type, unicode)(value)
+        except ValueError:
+            raise Error(400,
+                        title="Bad Request",
+                        code="400",
+                        message="invalid value {0!r} for {1!r}".format(value, field))
+
+
+def _get_field(message, path):
+    for name in path.split("."):
+        message = getattr(message, name)
+    return message
+
+
+def _field_descriptor(message, path):
+    names = path.split(".")
+    for name in names[:-1]:
+        message = getattr(message, name)
+    return message.DESCRIPTOR.fields_by_name[names[-1]]
+
+
+def _boolean(value):
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise ValueError(value)
+
+
+# FieldDescriptor.CPPTYPE_* to the conversion of a query string value
+_CONVERTERS = {
+    1: int,      # INT32
+    2: long,     # INT64
+    3: int,      # UINT32
+    4: long,     # UINT64
+    5: float,    # DOUBLE
+    6: float,    # FLOAT
+    7: _boolean, # BOOL
+    8: int,      # ENUM
+}
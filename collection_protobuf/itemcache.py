@@ -0,0 +1,176 @@
+"""
+Item level caching of query results
+
+    class MyService(ItemCachedService, Service):
+        item_cache = ItemCache()
+
+The serialized item of each value, as rendered by self._item() and the
+item hooks, is cached by self._value_key() and self._value_version().
+A query concatenates the cached bytes of the items and only renders
+the items that changed; the result carries them in Result.tail so
+they are not parsed again to serialize the response.
+
+The hook of service.item_hook_scope() is not cached, it is called
+with an empty item for every value and its fields are merged over
+the cached item.
+
+store() invalidates the key of the stored value, delete() the key
+returned by self._delete_key(), both before and after the write.
+"""
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from collection_protobuf.service import current_item_hook, item_hook_scope
+from collection_protobuf.utils import encode_varint, field_tag
+import threading
+
+
+class ItemCache(object):
+    """
+    A LRU cache of serialized items
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.__lock:
+            entry = self.__items.pop(key, None)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.__items[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, byte_string):
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__items[key] = (version, byte_string)
+            while len(self.__items) > self.size:
+                self.__items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__items.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+
+class ItemCachedService(object):
+    __metaclass__ = ABCMeta
+
+    # The ItemCache() of the service
+    item_cache = None
+
+    @abstractmethod
+    def _value_key(self, value):
+        """
+        _value_key(self, value()) -> str()
+
+        The key the item of a value is cached under
+        """
+
+    def _value_version(self, value):
+        """
+        _value_version(self, value()) -> object()
+
+        The version of a value, a cached item is only used while the
+        version is the same.  None when only writes through this
+        service change values.
+        """
+        return None
+
+    def _delete_key(self, *args, **kwargs):
+        """
+        _delete_key(self, *args, **kwargs) -> str()
+
+        The key removed by delete(), None to invalidate every item
+        """
+        return None
+
+    def _process_items(self, result, values):
+        if self.item_cache is None:
+            return super(ItemCachedService, self)._process_items(result, values)
+
+        head = result.head
+        item_tag = field_tag(head.collection, "items")
+        hook = current_item_hook()
+        scratch = call_item = None
+        chunks = []
+        for value in self._within_deadline(head, values):
+            key = self._value_key(value)
+            version = self._value_version(value)
+            byte_string = self.item_cache.get(key, version)
+            if byte_string is None:
+                if scratch is None:
+                    scratch = self._resource_class()()
+                scratch.Clear()
+                # The hook of the call differs between calls, it is
+                # not cached
+                with item_hook_scope(None):
+                    byte_string = self._add_item(scratch, value).SerializeToString()
+                self.item_cache.set(key, version, byte_string)
+            if hook is not None:
+                # The fields set by the hook are merged over the cached
+                # item when the resource is parsed
+                if call_item is None:
+                    call_item = self._resource_class()().collection.items.add()
+                call_item.Clear()
+                hook(call_item, value)
+                byte_string += call_item.SerializeToString()
+            chunks.append(item_tag)
+            chunks.append(encode_varint(len(byte_string)))
+            chunks.append(byte_string)
+
+        # Wrap the items in a collection field of the resource, it is
+        # merged with the collection of the head when parsed
+        collection = "".join(chunks)
+        result.tail += "".join([field_tag(head, "collection"),
+                                encode_varint(len(collection)),
+                                collection])
+
+    def _store_value(self, value):
+        if self.item_cache is None:
+            return super(ItemCachedService, self)._store_value(value)
+        with self.__invalidating([self._value_key(value)]):
+            return super(ItemCachedService, self)._store_value(value)
+
+    def _store_values(self, values):
+        if self.item_cache is None:
+            return super(ItemCachedService, self)._store_values(values)
+        with self.__invalidating([self._value_key(value) for value in values]):
+            return super(ItemCachedService, self)._store_values(values)
+
+    def _delete(self, *args, **kwargs):
+        if self.item_cache is None:
+            return super(ItemCachedService, self)._delete(*args, **kwargs)
+        key = self._delete_key(*args, **kwargs)
+        with self.__invalidating(None if key is None else [key]):
+            return super(ItemCachedService, self)._delete(*args, **kwargs)
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    @contextmanager
+    def __invalidating(self, keys):
+        # A query racing the write may cache the old bytes again
+        # between the invalidation and the write, so the keys are
+        # invalidated once more after it.  None invalidates every item.
+        self.__invalidate(keys)
+        try:
+            yield
+        finally:
+            self.__invalidate(keys)
+
+    def __invalidate(self, keys):
+        if keys is None:
+            self.item_cache.clear()
+            return
+        for key in keys:
+            self.item_cache.invalidate(key)
@@ -0,0 +1,250 @@
+"""
+On demand profiles of single requests
+
+    class MyView(ServiceView):
+        profiler = Profiler(RingBufferSink(), rate=0.001, token="s3cret")
+
+A request is profiled when it sends the X-Profile header with the
+token or when it is sampled at rate.  Without a token the header is
+ignored, anyone could otherwise put the server under cProfile.  The
+whole request runs under cProfile, and with memory=True under
+tracemalloc where it is available, and the time spent in the phases
+of the call is recorded:
+
+    _query      calling self._query()
+    _item       rendering the items with self._item()
+    hooks       running the item hooks
+    serialize   serializing the result
+
+The profile goes to a sink, DirectorySink writes the stats to files
+and RingBufferSink keeps the latest reports for ProfileView.
+
+Requests that are not profiled only pay for the sampling decision and
+a thread local lookup per item.  Service.profiler profiles calls to
+query() made outside of a ServiceView.
+"""
+from collections import deque
+from contextlib import contextmanager
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def current_profile():
+    """
+    current_profile() -> Profile()
+
+    The profile of the current call, None if it is not profiled
+    """
+    return getattr(_local, "profile", None)
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_PHASE = _NullPhase()
+
+
+def phase(name):
+    """
+    Record the time spent in the block as phase name of the current
+    profile, if any
+    """
+    profile = current_profile()
+    if profile is None:
+        return NULL_PHASE
+    return profile.phase(name)
+
+
+class _Phase(object):
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.phases[self.name] = (self.phases.get(self.name, 0.0)
+                                  + time.time() - self.start)
+
+
+class Profile(object):
+    def __init__(self, label, memory=False):
+        self.id = "{0}-{1}".format(os.getpid(), next(_ids))
+        self.label = label
+        self.memory = memory
+        self.phases = {}
+        self.started = None
+        self.elapsed = None
+        self.cpu = None
+        self.allocations = None
+
+    def phase(self, name):
+        return _Phase(self.phases, name)
+
+    def start(self):
+        import cProfile
+        self.started = time.time()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.cpu = cProfile.Profile()
+        self.cpu.enable()
+
+    def stop(self):
+        self.cpu.disable()
+        self.elapsed = time.time() - self.started
+        if self.memory:
+            import tracemalloc
+            self.allocations = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def stats(self, limit=30):
+        """
+        stats(self, int()) -> str()
+
+        The functions that took the most cumulative time
+        """
+        from cStringIO import StringIO
+        import pstats
+        output = StringIO()
+        stats = pstats.Stats(self.cpu, stream=output)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+    def top_allocations(self, limit=30):
+        """
+        top_allocations(self, int()) -> [str()]
+
+        The lines that allocated the most memory, None without memory
+        profiling
+        """
+        if self.allocations is None:
+            return None
+        return [str(stat) for stat in
+                self.allocations.statistics("lineno")[:limit]]
+
+    def report(self):
+        """
+        report(self) -> dict()
+        """
+        return {
+            "id": self.id,
+            "label": self.label,
+            "started": self.started,
+            "elapsed": self.elapsed,
+            "phases": dict(self.phases),
+            "stats": self.stats(),
+            "allocations": self.top_allocations(),
+        }
+
+
+class Profiler(object):
+    """
+    Decides which calls are profiled and sends their profiles to sink
+    """
+    def __init__(self, sink, rate=0.0, header="X-Profile", token=None,
+                 memory=False):
+        """
+        A request is profiled when it has the header with the value
+        token, or at random with the probability rate.  The header is
+        only honored when token is set.
+        """
+        if memory:
+            try:
+                import tracemalloc
+            except ImportError:
+                raise ValueError("memory profiling needs tracemalloc")
+        self.sink = sink
+        self.rate = rate
+        self.header = header
+        self.token = token
+        self.memory = memory
+
+    def sample(self, requested=False):
+        """
+        sample(self, bool()) -> bool()
+
+        True if the call should be profiled
+        """
+        if current_profile() is not None:
+            # cProfile does not nest
+            return False
+        return requested or (self.rate > 0 and random.random() < self.rate)
+
+    def requested(self, header_value):
+        """
+        requested(self, str()) -> bool()
+
+        True if the value of the profile header asks for a profile
+        """
+        if self.header is None or self.token is None or header_value is None:
+            return False
+        return header_value == self.token
+
+    @contextmanager
+    def profile(self, label):
+        profile = Profile(label, self.memory)
+        _local.profile = profile
+        profile.start()
+        try:
+            yield profile
+        finally:
+            profile.stop()
+            _local.profile = None
+            try:
+                self.sink.add(profile)
+            except Exception:
+                log.exception("Error saving profile")
+
+
+###================================================================
+### Sinks
+###================================================================
+class RingBufferSink(object):
+    """
+    Keep the reports of the latest size profiles in memory
+    """
+    def __init__(self, size=50):
+        self.__reports = deque(maxlen=size)
+        self.__lock = threading.Lock()
+
+    def add(self, profile):
+        report = profile.report()
+        with self.__lock:
+            self.__reports.append(report)
+
+    def reports(self):
+        with self.__lock:
+            return list(self.__reports)
+
+
+class DirectorySink(object):
+    """
+    Write each profile to path as <id>.prof, loadable with pstats,
+    and <id>.json with the report
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def add(self, profile):
+        import json
+        base = os.path.join(self.path, profile.id)
+        profile.cpu.dump_stats(base + ".prof")
+        with open(base + ".json", "w") as f:
+            json.dump(profile.report(), f, indent=2)
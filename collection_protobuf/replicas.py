@@ -0,0 +1,216 @@
+"""
+Route reads over a pool of replica backends
+
+    class MyService(ReplicatedService, Service):
+        replicas = ReplicaPool({"db1": query_db1, "db2": query_db2})
+
+Each replica is a callable with the signature of Service._query().
+A query goes to the healthy replica with the fewest outstanding
+requests.  When it has not answered after the hedge_percentile latency
+of the pool a second replica is asked as well and the first answer
+wins.
+
+Replicas that fail max_failures times in a row, or whose median
+latency is outlier_factor times the median of the pool, are ejected for
+ejection_time seconds.
+
+Writes are not routed, _save() and _delete() still go to the primary.
+"""
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from collection_protobuf.service import (DeadlineExceeded, Error, current_deadline,
+                                         deadline_scope)
+import logging
+import random
+import threading
+import time
+import Queue
+
+log = logging.getLogger(__name__)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    i = int(round((len(values) - 1) * pct / 100.0))
+    return values[i]
+
+
+class Replica(object):
+    def __init__(self, name, query, window):
+        self.name = name
+        self.query = query
+        self.latencies = deque(maxlen=window)
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0
+
+    def ejected(self, now):
+        return self.ejected_until > now
+
+    def __repr__(self):
+        return "Replica({0!r})".format(self.name)
+
+
+class ReplicaPool(object):
+    # Hedge after this percentile of the recent latencies of the pool
+    hedge_percentile = 95
+    # Hedge delay before enough latencies are known
+    initial_hedge_delay = 0.05
+    min_hedge_delay = 0.001
+    # Consecutive failures before a replica is ejected
+    max_failures = 5
+    # Median latency relative to the pool before a replica is ejected
+    outlier_factor = 3.0
+    # Latencies needed before a replica can be an outlier
+    min_samples = 20
+    ejection_time = 30.0
+    window = 100
+
+    def __init__(self, backends, workers=None):
+        """
+        backends is a dict of replica name to query callable
+        """
+        self.replicas = [Replica(name, query, self.window)
+                         for name, query in sorted(backends.iteritems())]
+        self.latencies = deque(maxlen=self.window * len(self.replicas))
+        self.__lock = threading.Lock()
+        self.__pool = ThreadPool(workers or 2 * len(self.replicas))
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def query(self, *args, **kwargs):
+        """
+        query(self, *args, **kwargs) -> [value()]
+
+        Query a replica, hedging with a second one when the first is
+        slow.  Return the values of the first replica to answer.
+        """
+        # The deadline is thread local, the workers get it passed
+        deadline = current_deadline()
+        candidates = self.__candidates()
+        answers = Queue.Queue()
+        self.__start(candidates.pop(0), answers, deadline, args, kwargs)
+        running = 1
+
+        error = None
+        hedged = False
+        while running:
+            timeout = None if hedged else self.hedge_delay()
+            if deadline is not None:
+                remaining = max(0, deadline.remaining())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                ok, value = answers.get(timeout=timeout)
+            except Queue.Empty:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded()
+                # Hedge
+                if candidates:
+                    self.__start(candidates.pop(0), answers, deadline, args, kwargs)
+                    running += 1
+                hedged = True
+                continue
+
+            running -= 1
+            if ok:
+                return value
+            error = value
+            # The first replica failed, try the next before giving up
+            if not running and candidates:
+                self.__start(candidates.pop(0), answers, deadline, args, kwargs)
+                running += 1
+        raise error
+
+    def hedge_delay(self):
+        with self.__lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_hedge_delay
+            delay = percentile(self.latencies, self.hedge_percentile)
+        return max(delay, self.min_hedge_delay)
+
+    def close(self):
+        self.__pool.close()
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __candidates(self):
+        now = time.time()
+        with self.__lock:
+            healthy = [r for r in self.replicas if not r.ejected(now)]
+            # Never eject the whole pool
+            replicas = healthy or list(self.replicas)
+            random.shuffle(replicas)
+            replicas.sort(key=lambda r: r.outstanding)
+            return replicas
+
+    def __start(self, replica, answers, deadline, args, kwargs):
+        with self.__lock:
+            replica.outstanding += 1
+        self.__pool.apply_async(
+            self.__call, (replica, answers, deadline, args, kwargs))
+
+    def __call(self, replica, answers, deadline, args, kwargs):
+        start = time.time()
+        try:
+            with deadline_scope(deadline):
+                values = replica.query(*args, **kwargs)
+                if values is not None:
+                    values = list(values)
+        except Error, e:
+            # A client error is not the replica's fault
+            self.__done(replica, time.time() - start, failed=e.status >= 500)
+            answers.put((False, e))
+        except Exception, e:
+            log.exception("Error querying {0!r}".format(replica))
+            self.__done(replica, time.time() - start, failed=True)
+            answers.put((False, e))
+        else:
+            self.__done(replica, time.time() - start, failed=False)
+            answers.put((True, values))
+
+    def __done(self, replica, latency, failed):
+        now = time.time()
+        with self.__lock:
+            replica.outstanding -= 1
+            if failed:
+                replica.failures += 1
+                if replica.failures >= self.max_failures:
+                    self.__eject(replica, now, "failing")
+                return
+
+            replica.failures = 0
+            replica.latencies.append(latency)
+            self.latencies.append(latency)
+            if self.__is_outlier(replica, now):
+                self.__eject(replica, now, "slow")
+
+    def __is_outlier(self, replica, now):
+        if len(replica.latencies) < self.min_samples:
+            return False
+        others = [percentile(r.latencies, 50) for r in self.replicas
+                  if r is not replica and not r.ejected(now)
+                  and len(r.latencies) >= self.min_samples]
+        if not others:
+            return False
+        pool_median = percentile(others, 50)
+        return percentile(replica.latencies, 50) > self.outlier_factor * pool_median
+
+    def __eject(self, replica, now, reason):
+        log.warning("Ejecting {0} replica {1!r}".format(reason, replica))
+        replica.ejected_until = now + self.ejection_time
+        replica.failures = 0
+        replica.latencies.clear()
+
+
+class ReplicatedService(object):
+    # A ReplicaPool() to read from, None to read from the primary
+    replicas = None
+
+    def _query(self, *args, **kwargs):
+        if self.replicas is None:
+            return super(ReplicatedService, self)._query(*args, **kwargs)
+        return self.replicas.query(*args, **kwargs)
@@ -0,0 +1,271 @@
+"""
+Connection pools for the backends of a Service
+
+    class MyService(Service):
+        resources = ResourceManager([
+            Pool("db", connect_db, size=10, health_check=ping),
+        ])
+
+        def _save(self, value):
+            db = self.resource("db")
+            ...
+
+Every Service call borrows the connections it asks for with
+self.resource() and returns them when the call is done.  When the call
+raises, the connections are health checked before they go back into
+the pool.
+
+Call ResourceManager.start() at startup to open and check the
+connections before the first request.
+"""
+from collections import deque
+from contextlib import contextmanager
+from collection_protobuf.service import Error
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Pool(object):
+    def __init__(self, name, factory, size=10, timeout=1.0,
+                 health_check=None, close=None, check_interval=30.0):
+        """
+        factory() opens a connection, health_check(conn) returns
+        False for broken connections and close(conn) closes one.
+
+        Idle connections are checked before they are reused when they
+        have not been used for check_interval seconds.
+        """
+        self.name = name
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.close_connection = close
+        self.check_interval = check_interval
+
+        self.__idle = deque()
+        self.__created = 0
+        self.__waiting = 0
+        self.__cond = threading.Condition()
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.wait_time = 0.0
+        self.peak_in_use = 0
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def acquire(self):
+        """
+        acquire(self) -> connection()
+
+        Raise a 503 service.Error() when no connection is free within
+        self.timeout seconds
+        """
+        while True:
+            conn, last_used = self.__checkout()
+            if conn is None:
+                return self.__open()
+            if (self.health_check is None
+                or time.time() - last_used < self.check_interval
+                or self.__healthy(conn)):
+                return conn
+            self.__discard(conn)
+
+    def release(self, conn, check=False):
+        """
+        Return a connection to the pool, health check it first when
+        check is True
+        """
+        if check and self.health_check is not None and not self.__healthy(conn):
+            self.__discard(conn)
+            return
+        with self.__cond:
+            self.__idle.append((conn, time.time()))
+            self.__cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except:
+            self.release(conn, check=True)
+            raise
+        else:
+            self.release(conn)
+
+    def warmup(self, count=None):
+        """
+        Open count connections, self.size by default
+        """
+        conns = []
+        try:
+            for _ in xrange(count or self.size):
+                conns.append(self.acquire())
+        finally:
+            for conn in conns:
+                self.release(conn, check=True)
+
+    def stats(self):
+        with self.__cond:
+            in_use = self.__created - len(self.__idle)
+            return {
+                "size": self.size,
+                "created": self.__created,
+                "idle": len(self.__idle),
+                "in_use": in_use,
+                "waiting": self.__waiting,
+                "saturation": float(in_use) / self.size,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "discarded": self.discarded,
+                "wait_time": self.wait_time,
+            }
+
+    def close(self):
+        with self.__cond:
+            idle = list(self.__idle)
+            self.__idle.clear()
+            self.__created -= len(idle)
+        for conn, _ in idle:
+            self.__close(conn)
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __checkout(self):
+        """
+        Return an idle connection, or (None, None) when a new
+        connection may be opened
+        """
+        start = time.time()
+        with self.__cond:
+            self.__waiting += 1
+            try:
+                while not self.__idle and self.__created >= self.size:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise Error(
+                            503,
+                            title="Service Unavailable",
+                            code="503",
+                            message="timed out waiting for a {0} connection".format(self.name))
+                    self.__cond.wait(remaining)
+            finally:
+                self.__waiting -= 1
+                self.wait_time += time.time() - start
+
+            self.checkouts += 1
+            if self.__idle:
+                conn, last_used = self.__idle.pop()
+            else:
+                self.__created += 1
+                conn, last_used = None, None
+            self.peak_in_use = max(self.peak_in_use,
+                                   self.__created - len(self.__idle))
+            return conn, last_used
+
+    def __open(self):
+        try:
+            return self.factory()
+        except:
+            with self.__cond:
+                self.__created -= 1
+                self.__cond.notify()
+            raise
+
+    def __healthy(self, conn):
+        try:
+            return self.health_check(conn)
+        except Exception:
+            log.exception("Error checking {0} connection".format(self.name))
+            return False
+
+    def __discard(self, conn):
+        with self.__cond:
+            self.__created -= 1
+            self.discarded += 1
+            self.__cond.notify()
+        self.__close(conn)
+
+    def __close(self, conn):
+        if self.close_connection is None:
+            return
+        try:
+            self.close_connection(conn)
+        except Exception:
+            log.exception("Error closing {0} connection".format(self.name))
+
+
+class ResourceManager(object):
+    def __init__(self, pools=()):
+        self.pools = dict((pool.name, pool) for pool in pools)
+        self.__local = threading.local()
+
+    def add(self, pool):
+        self.pools[pool.name] = pool
+
+    def start(self):
+        """
+        Open and check the connections of every pool
+        """
+        for pool in self.pools.itervalues():
+            pool.warmup()
+
+    def close(self):
+        for pool in self.pools.itervalues():
+            pool.close()
+
+    def stats(self):
+        return dict((name, pool.stats())
+                    for name, pool in self.pools.iteritems())
+
+    @contextmanager
+    def borrow(self):
+        """
+        Return the connections taken with self.get() when the block
+        exits.  Nested blocks share the outer block's connections.
+        """
+        if getattr(self.__local, "borrowed", None) is not None:
+            yield
+            return
+
+        borrowed = self.__local.borrowed = {}
+        try:
+            yield
+        except Error:
+            self.__release(borrowed, check=False)
+            raise
+        except:
+            self.__release(borrowed, check=True)
+            raise
+        else:
+            self.__release(borrowed, check=False)
+        finally:
+            self.__local.borrowed = None
+
+    def get(self, name):
+        """
+        get(self, str()) -> connection()
+
+        Return the connection of pool name borrowed for the current
+        block
+        """
+        borrowed = getattr(self.__local, "borrowed", None)
+        if borrowed is None:
+            raise RuntimeError("resources are only available within borrow()")
+        if name not in borrowed:
+            borrowed[name] = self.pools[name].acquire()
+        return borrowed[name]
+
+    def __release(self, borrowed, check):
+        for name, conn in borrowed.iteritems():
+            self.pools[name].release(conn, check=check)
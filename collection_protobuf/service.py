@@ -4,10 +4,20 @@ implementing a collection+protobuf service
 """
 from abc import ABCMeta, abstractmethod, abstractproperty
 from contextlib import contextmanager
+from collection_protobuf.profiling import NULL_PHASE, current_profile, phase
+from collection_protobuf.utils import append_msg, import_string, resolve_class
 import logging
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
+# Link relations used by delta queries
+CHANGES_REL = "changes"
+TOMBSTONE_REL = "tombstone"
+# Link relation marking a query result cut short by its deadline
+PARTIAL_REL = "partial"
+
 def trace(val):
     log.debug("{!r}".format(val))
     return val
@@ -37,9 +47,9 @@ class Error(Exception):
         Set the error message of a resource
         """
         error = resource.collection.error
-        error.title = title
-        error.code = code
-        error.message = message
+        error.title = self.title
+        error.code = self.code
+        error.message = self.message
 
 def reraise(result):
     error = result.resource.collection.error
@@ -51,11 +61,101 @@ def reraise(result):
         title=error.title)
 
 
+class UseAfterRelease(Exception):
+    pass
+
+
+class MessagePool(object):
+    """
+    A pool of cleared messages to reuse instead of allocating new ones
+
+    In debug mode acquire() checks that the messages were not modified
+    after they were released.
+    """
+    def __init__(self, factory, size=64, debug=False):
+        """
+        factory is the message class or its dotted path
+        """
+        self.factory = factory
+        self.size = size
+        self.debug = debug
+        self.__free = []
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        with self.__lock:
+            pb = self.__free.pop() if self.__free else None
+        if pb is None:
+            if isinstance(self.factory, basestring):
+                self.factory = import_string(self.factory)
+            return self.factory()
+        if self.debug and pb.ByteSize():
+            raise UseAfterRelease("{0!r} was modified after it was released".format(
+                pb.DESCRIPTOR.full_name))
+        return pb
+
+    def release(self, pb):
+        pb.Clear()
+        with self.__lock:
+            if len(self.__free) < self.size:
+                self.__free.append(pb)
+
+
 class Result(object):
-    def __init__(self, status, resource, cached=False):
+    """
+    The status and resource of a call
+
+    tail holds serialized Resource fields that follow the resource
+    message, they are merged into the resource when it is first used.
+    serialize() and head avoid parsing the tail.
+    """
+    __slots__ = ("status", "_resource", "cached", "pool", "released", "tail")
+
+    def __init__(self, status, resource, cached=False, pool=None, tail=""):
         self.status = status
-        self.resource = resource
+        self._resource = resource
         self.cached = cached
+        self.pool = pool
+        self.released = False
+        self.tail = tail
+
+    @property
+    def resource(self):
+        resource = self.head
+        if self.tail:
+            resource.MergeFromString(self.tail)
+            self.tail = ""
+        return resource
+
+    @property
+    def head(self):
+        """
+        The resource without the tail
+        """
+        if self.released:
+            raise UseAfterRelease("the resource of {0!r} was released".format(self))
+        return self._resource
+
+    def serialize(self):
+        with phase("serialize"):
+            return self.head.SerializeToString() + self.tail
+
+    @resource.setter
+    def resource(self, resource):
+        self._resource = resource
+
+    def release(self):
+        """
+        Return the resource to its MessagePool(), the resource must not
+        be used after this
+        """
+        if self.pool is None or self.released:
+            return
+        self.released = True
+        self.tail = ""
+        if self._resource is not None:
+            self.pool.release(self._resource)
+            self._resource = None
 
 
 @contextmanager
@@ -64,23 +164,113 @@ def result_manager(status, resource):
     try:
         yield result
     except Error, err:
-        msg = result.resource.collection.error
-        msg.title = err.title
-        msg.code = err.code
-        msg.message = err.message
+        if result.resource is not None:
+            msg = result.resource.collection.error
+            msg.title = err.title
+            msg.code = err.code
+            msg.message = err.message
         result.status = err.status
     except Exception, e:
-        msg = result.resource.collection.error
-        msg.title = "Internal Server Error"
-        msg.code = "500"
-        msg.message = "The server have encountered an error, please wait and try again."
+        if result.resource is not None:
+            msg = result.resource.collection.error
+            msg.title = "Internal Server Error"
+            msg.code = "500"
+            msg.message = "The server have encountered an error, please wait and try again."
         result.status = 500
         log.exception("Error creating result")
 
 
+class DeadlineExceeded(Error):
+    def __init__(self):
+        super(DeadlineExceeded, self).__init__(
+            504,
+            title="Gateway Timeout",
+            code="504",
+            message="The request did not complete within its deadline.")
+
+
+class Deadline(object):
+    """
+    The point in time by which a call has to be done
+    """
+    def __init__(self, timeout):
+        self.at = time.time() + timeout
+
+    def remaining(self):
+        return max(0.0, self.at - time.time())
+
+    def expired(self):
+        return time.time() >= self.at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded()
+
+
+_local = threading.local()
+
+def current_deadline():
+    """
+    current_deadline() -> Deadline()
+
+    The deadline of the current call, None if it has none
+    """
+    return getattr(_local, "deadline", None)
+
+@contextmanager
+def deadline_scope(deadline):
+    """
+    Make deadline the current deadline within the block, an existing
+    deadline is kept when deadline is None
+    """
+    previous = current_deadline()
+    if deadline is not None:
+        _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+def current_item_hook():
+    """
+    current_item_hook() -> callable()
+
+    The item hook of the current call, None if it has none
+    """
+    return getattr(_local, "item_hook", None)
+
+@contextmanager
+def item_hook_scope(hook):
+    """
+    Call hook(item, value) for the items added within the block, after
+    the item_hooks of the service.  Unlike item_hooks it only applies
+    to the current call, ServiceView uses it for the hook of a request.
+    """
+    previous = current_item_hook()
+    _local.item_hook = hook
+    try:
+        yield
+    finally:
+        _local.item_hook = previous
+
+
 class Service(object):
     __metaclass__ = ABCMeta
 
+    # A changes.Broker() to publish item changes to
+    changes = None
+    # A resources.ResourceManager() with the pools of the backends
+    resources = None
+    # Return the items found so far with a "partial" link instead of
+    # a 504 error when a query runs out of time
+    partial_on_deadline = False
+    # A MessagePool() to take the resources of results from, results
+    # must then be released with Result.release()
+    resource_pool = None
+    # A profiling.Profiler() for query(), see ServiceView.profiler for
+    # profiling requests
+    profiler = None
+
     def __init__(self, *args, **kwargs):
         super(Service, self).__init__()
         self.item_hooks = ItemHooks()
@@ -93,37 +283,100 @@ class Service(object):
         query(self, *args, **kwargs) -> Result()
 
         Query the service and return a Result()
+
+        If a ``since`` token is given only the items that changed
+        since that token are returned, see self._query_changes()
+
+        A ``deadline`` bounds the time spent on the query
         """
-        with result_manager(200, self._resource_pb()) as result:
-            self.__query(result, *args, **kwargs)
+        since = kwargs.pop("since", None)
+        deadline = kwargs.pop("deadline", None)
+        with self._profile("query"):
+            with self._result_manager(200, self._resource_pb(), deadline) as result:
+                if since is None:
+                    self.__query(result, *args, **kwargs)
+                else:
+                    self.__query_changes(result, since)
         return result
 
-    def store_bytes(self, byte_string):
-        with result_manager(200, self._resource_pb()) as result:
+    def store_bytes(self, byte_string, deadline=None):
+        with self._result_manager(200, self._resource_pb(), deadline) as result:
             self.__store(result, 
                          self.__parse_collection(result, byte_string).template)
         return result
 
-    def store(self, template_collection):
+    def store(self, template_collection, deadline=None):
         """
         store(self, template_collection) -> Result()
 
         Store template into
         """
-        with result_manager(200, self._resource_pb()) as result:
+        with self._result_manager(200, self._resource_pb(), deadline) as result:
             self.__store(result, template_collection.template)
         return result
 
+    def store_many(self, template_collections, deadline=None):
+        """
+        store_many(self, [template_collection]) -> Result()
+
+        Validate and store a batch of templates with one call to
+        self._store_values().  The batch fails as a whole when a
+        template does not validate.
+        """
+        with self._result_manager(200, self._resource_pb(), deadline) as result:
+            values = [self._validate_template(collection.template)
+                      for collection in template_collections]
+            self._check_deadline()
+            self._store_values(values)
+            if self.changes is not None:
+                for value in values:
+                    self.__publish(value)
+        return result
+
+    def iter_items(self, *args, **kwargs):
+        """
+        iter_items(self, *args, **kwargs) -> iterator(Message())
+
+        Iterate the items of a query one at a time.  The same item
+        message is reused for every value, serialize or copy it before
+        taking the next.
+
+        Raise a service.Error() if the query is not found.
+        """
+        # The connections stay borrowed while the items are iterated
+        with self._borrow():
+            value_iter = self._query(*args, **kwargs)
+            if value_iter is None:
+                raise Error(404, title="Not Found", code="404", message="resource not found")
+            scratch = self._resource_class()()
+            for value in value_iter:
+                scratch.Clear()
+                yield self._add_item(scratch, value)
+
     def delete(self, *args, **kwargs):
         """
         delete(self, item) -> Result()
         """
-        with result_manager(204, None) as result:
+        deadline = kwargs.pop("deadline", None)
+        with self._result_manager(204, None, deadline) as result:
+            self._check_deadline()
             if not self._delete(*args, **kwargs):
                 result.status = 404
+            elif self.changes is not None:
+                self.__publish(self._deleted_value(*args, **kwargs),
+                               removed=True)
         return result
 
 
+    def resource(self, name):
+        """
+        resource(self, str()) -> connection()
+
+        Borrow a connection from the pool name of self.resources until
+        the current call returns
+        """
+        return self.resources.get(name)
+
     ###================================================================
     ### Abstract properties and methods
     ###================================================================
@@ -134,6 +387,10 @@ class Service(object):
 
         Return a protobuf message that is shaped like the Resource
         message as defined by the collection+protobuf specification
+
+        This may also be the dotted path of the message class, the
+        generated module is then imported on the first call to
+        self._resource_pb()
         """
 
     @abstractmethod
@@ -170,6 +427,17 @@ class Service(object):
         """
         pass
 
+    def _save_many(self, values):
+        """
+        _save_many(self, [value()]) -> [int()]
+
+        Save a batch of values, return the status code of each save.
+
+        Override this when the backend can write batches faster than
+        calling self._save() for each value.
+        """
+        return [self._save(value) for value in values]
+
     @abstractmethod
     def _delete(self, item):
         """
@@ -192,14 +460,177 @@ class Service(object):
         """
         Used to configure the resource message
         """
-        return self._ResourcePB()
+        if self.resource_pool is not None:
+            return self.resource_pool.acquire()
+        return self._resource_class()()
+
+    def _resource_class(self):
+        return resolve_class(type(self), "_ResourcePB")
+
+    def _store_value(self, value):
+        """
+        _store_value(self, value()) -> int()
+
+        Called with the value returned by self._validate_template(),
+        return the status of the store.  Saves the value with
+        self._save() by default.
+        """
+        return self._save(value)
+
+    def _store_values(self, values):
+        """
+        _store_values(self, [value()]) -> [int()]
+
+        Called by store_many() with the validated values, saves them
+        with self._save_many() by default.
+        """
+        return self._save_many(values)
+
+    def _item_template(self, item, template):
+        """
+        _item_template(self, Message(), Message()) -> Message()
+
+        Fill the template to store from an item, used to load exported
+        items.  Copies the fields the item and template have in common
+        by default.
+        """
+        for field in template.DESCRIPTOR.fields:
+            if field.name not in item.DESCRIPTOR.fields_by_name:
+                continue
+            if field.type == field.TYPE_MESSAGE:
+                # The template and item messages are wire compatible
+                getattr(template, field.name).MergeFromString(
+                    getattr(item, field.name).SerializeToString())
+            elif field.label != field.LABEL_REPEATED:
+                setattr(template, field.name, getattr(item, field.name))
+        return template
+
+    def _query_changes(self, since):
+        """
+        _query_changes(self, str()) -> (str(), iterator(value()), iterator(value()))
+
+        Return a tuple of the new token, the values changed since the
+        `since` token and the values removed since the `since` token.
+
+        Removed values are passed to self._item() and returned as
+        tombstones.
+
+        Return None if the token is unknown or has expired, the client
+        will have to re-query the whole collection.
+        """
+        return None
+
+    def _changes_token(self):
+        """
+        _changes_token(self) -> str()
+
+        Return the token for the current version of the collection.
+        The token is added to the links of every full query so that
+        clients can start asking for changes.
+
+        Return None if delta queries are not supported.
+        """
+        return None
+
+    def _queries(self, collection):
+        """
+        _queries(self, Message()) -> None
+
+        Add the queries the service answers to collection.queries,
+        called for every full query
+        """
+
+    def _deleted_value(self, *args, **kwargs):
+        """
+        _deleted_value(self, *args, **kwargs) -> value()
+
+        Called with the arguments of a successful self.delete() when
+        self.changes is set.  Return the value passed to self._item()
+        to render the tombstone that is published.
+
+        Return None to not publish the delete.
+        """
+        return None
+
+    @contextmanager
+    def _result_manager(self, status, resource, deadline=None):
+        """
+        Wraps every public call, errors raised in the block are
+        turned into the status and error of the Result()
+        """
+        with result_manager(status, resource) as result:
+            if resource is not None:
+                result.pool = self.resource_pool
+            with deadline_scope(deadline):
+                with self._borrow():
+                    yield result
+
+    def _profile(self, name):
+        """
+        Profile the block with self.profiler when the call is sampled
+        """
+        if self.profiler is None or not self.profiler.sample():
+            return NULL_PHASE
+        return self.profiler.profile("{0}.{1}".format(type(self).__name__, name))
+
+    def _remaining(self):
+        """
+        _remaining(self) -> float()
+
+        Seconds left before the deadline of the current call, None if
+        the call has no deadline
+        """
+        deadline = current_deadline()
+        if deadline is None:
+            return None
+        return deadline.remaining()
+
+    def _within_deadline(self, resource, values):
+        """
+        _within_deadline(self, Message(), iterator(value())) -> iterator(value())
+
+        Iterate values until the deadline of the current call, see
+        self.partial_on_deadline
+        """
+        deadline = current_deadline()
+        if deadline is None:
+            return values
+        return self.__until(deadline, resource, values)
+
+    def _process_items(self, result, values):
+        """
+        Add the items of the values returned by self._query() to the
+        result
+        """
+        self.__process_items(result.resource, values)
+
+    def _check_deadline(self):
+        """
+        Raise DeadlineExceeded() when the current call is out of time
+        """
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check()
+
+    @contextmanager
+    def _borrow(self):
+        """
+        Make the connections of self.resources available to the block
+        """
+        if self.resources is None:
+            yield
+        else:
+            with self.resources.borrow():
+                yield
 
     ###================================================================
     ### Internal
     ###================================================================
     def __save_template(self, result, template):
         value = self._validate_template(template)
-        result.status = self._save(value)
+        self._check_deadline()
+        result.status = self._store_value(value)
+        return value
 
     def __update_template(self, resource, template):
         resource.collection.template.CopyFrom(template)
@@ -208,9 +639,23 @@ class Service(object):
         # Put the template into the collection in case 
         # validate or save raise a service.Error()
         self.__update_template(result.resource, template)
-        item = self.__save_template(result, template)
+        value = self.__save_template(result, template)
+        if self.changes is not None:
+            self.__publish(value)
         return result
 
+    def __publish(self, value, removed=False):
+        if value is None:
+            return
+        # A failed notification must not fail the write
+        try:
+            item = self._add_item(self._resource_class()(), value)
+            if removed:
+                tombstone(item)
+            self.changes.publish(item.SerializeToString())
+        except Exception:
+            log.exception("Error publishing change")
+
     def __parse_collection(self, result, byte_string):
         collection = result.resource.collection
         try:
@@ -224,22 +669,80 @@ class Service(object):
                 message=unicode(e))
 
     def __query(self, result, *args, **kwargs):
-        value_iter = self._query(*args, **kwargs)
+        # Take the token before querying, changes that race with the
+        # query are sent again on the next delta query
+        token = self._changes_token()
+        self._check_deadline()
+        with phase("_query"):
+            value_iter = self._query(*args, **kwargs)
         if value_iter is None:
             raise Error(404, title="Not Found", code="404", message="resource not found")
-        self.__process_items(result.resource, value_iter)
+        self._process_items(result, value_iter)
+        self.__add_changes_link(result.head, token)
+        self._queries(result.head.collection)
         return result
 
+    def __query_changes(self, result, since):
+        changes = self._query_changes(since)
+        if changes is None:
+            raise Error(410, title="Gone", code="410",
+                        message="changes are no longer available, query the collection again")
+        token, changed, removed = changes
+        self.__process_items(result.resource, changed)
+        for value in removed:
+            tombstone(self._add_item(result.resource, value))
+        self.__add_changes_link(result.resource, token)
+        return result
+
+    def __add_changes_link(self, resource, token):
+        if token is not None:
+            append_msg(resource.collection.links,
+                       rel=CHANGES_REL,
+                       href=token)
+
     def __process_items(self, resource, items):
-        for item in items:
-            self.__add_item(resource, item)
+        for item in self._within_deadline(resource, items):
+            self._add_item(resource, item)
         return resource
 
-    def __add_item(self, resource, value):
+    def __until(self, deadline, resource, values):
+        try:
+            for value in values:
+                if deadline.expired():
+                    if not self.partial_on_deadline:
+                        raise DeadlineExceeded()
+                    append_msg(resource.collection.links,
+                               rel=PARTIAL_REL,
+                               href="")
+                    return
+                yield value
+        finally:
+            # Stop the backend's generator from doing more work
+            close = getattr(values, "close", None)
+            if close is not None:
+                close()
+
+    def _add_item(self, resource, value):
+        """
+        Add the item of value to the resource
+        """
         item = resource.collection.items.add()
-        self._item(item, value)
-        self.item_hooks.do(item, value)
-    
+        hook = current_item_hook()
+        profile = current_profile()
+        if profile is None:
+            self._item(item, value)
+            self.item_hooks.do(item, value)
+            if hook is not None:
+                hook(item, value)
+        else:
+            with profile.phase("_item"):
+                self._item(item, value)
+            with profile.phase("hooks"):
+                self.item_hooks.do(item, value)
+                if hook is not None:
+                    hook(item, value)
+        return item
+
 
 class CachedService(object):
     def _cached_result(self, *args, **kwargs):
@@ -250,13 +753,20 @@ class CachedService(object):
                     resource.ParseFromString(packet)
                     log.debug("Using cached value {!r} {!r} {!r}".format(
                         self, args, kwargs))
-                    return Result(200, resource, cached=True)
+                    return Result(200, resource, cached=True,
+                                  pool=self.resource_pool)
             except:
                 log.exception("Error parsing cached value")
         
-    def query(self, nocache=False, *args, **kwargs):
-        if not nocache:
-            cached_result = self._cached_result(*args, **kwargs)
+    def query(self, *args, **kwargs):
+        # nocache is keyword only so that query(key) is not taken for
+        # query(nocache=key)
+        nocache = kwargs.pop("nocache", False)
+        # Delta queries are never served from the cache
+        if not nocache and kwargs.get("since") is None:
+            cache_kwargs = dict((k, v) for k, v in kwargs.iteritems()
+                                if k != "deadline")
+            cached_result = self._cached_result(*args, **cache_kwargs)
         else:
             cached_result = None
 
@@ -265,3 +775,14 @@ class CachedService(object):
         else:
             return super(CachedService, self).query(*args, **kwargs)
 
+
+def tombstone(item):
+    """
+    Mark an item as removed from the collection
+    """
+    append_msg(item.links, rel=TOMBSTONE_REL, href=item.href)
+    return item
+
+
+def is_tombstone(item):
+    return any(link.rel == TOMBSTONE_REL for link in item.links)
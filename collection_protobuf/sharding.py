@@ -0,0 +1,245 @@
+"""
+Spread a collection over several Service() backends
+
+ShardedService routes store() and delete() to one shard by the key of
+the template or item, shards are picked by consistent hashing.  Queries
+for a single key go to that key's shard, queries that list the
+collection go to every shard in parallel and the items are merged into
+one Result().
+"""
+from abc import ABCMeta, abstractmethod
+from bisect import bisect
+from hashlib import md5
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from collection_protobuf.service import (CachedService, Error, ItemHooks,
+                                         current_deadline, current_item_hook,
+                                         item_hook_scope, result_manager)
+from collection_protobuf.utils import resolve_class
+import heapq
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return int(md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring with vnodes virtual nodes per node
+    """
+    def __init__(self, nodes, vnodes=100):
+        ring = sorted(
+            (_hash("{0}#{1}".format(node, i)), node)
+            for node in nodes
+            for i in xrange(vnodes))
+        self.__hashes = [h for h, _ in ring]
+        self.__nodes = [node for _, node in ring]
+
+    def node(self, key):
+        i = bisect(self.__hashes, _hash(key)) % len(self.__hashes)
+        return self.__nodes[i]
+
+
+class ShardedService(object):
+    __metaclass__ = ABCMeta
+
+    vnodes = 100
+    # Merge the items of a scatter query in self._item_sort_key() order
+    ordered = False
+
+    def __init__(self, shards, vnodes=None):
+        """
+        shards is a dict of shard name to Service()
+        """
+        super(ShardedService, self).__init__()
+        self.shards = dict(shards)
+        self.ring = HashRing(sorted(self.shards), vnodes or self.vnodes)
+        # Hooks added to the sharded service apply to every shard
+        self.item_hooks = ItemHooks()
+        for shard in self.shards.itervalues():
+            shard.item_hooks = self.item_hooks
+        self.__pool = ThreadPool(len(self.shards))
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def shard(self, key):
+        return self.shards[self.ring.node(key)]
+
+    def query(self, *args, **kwargs):
+        """
+        query(self, *args, **kwargs) -> Result()
+
+        Delta queries are not supported, the tokens of the shards can
+        not be combined into one
+        """
+        since = kwargs.pop("since", None)
+        # The deadline is thread local, it is passed on explicitly so
+        # that the shard queries on the pool threads see it
+        options = {"deadline": kwargs.pop("deadline", None) or current_deadline()}
+        if kwargs.pop("nocache", False):
+            options["nocache"] = True
+        if since is not None:
+            with result_manager(200, self._resource_pb()) as result:
+                raise Error(501, title="Not Implemented", code="501",
+                            message="delta queries are not supported")
+            return result
+
+        key = self._query_key(*args, **kwargs)
+        if key is not None:
+            return self.__query_shard(self.shard(key), args, kwargs, options)
+        return self.__gather(self.__scatter(args, kwargs, options))
+
+    def store_bytes(self, byte_string, deadline=None):
+        with result_manager(200, self._resource_pb()) as result:
+            collection = result.resource.collection
+            try:
+                collection.ParseFromString(byte_string)
+            except Exception, e:
+                raise Error(
+                    400,
+                    title="Error parsing body",
+                    code="400",
+                    message=unicode(e))
+            return self.store(collection, deadline)
+        return result
+
+    def store(self, template_collection, deadline=None):
+        """
+        store(self, template_collection) -> Result()
+        """
+        with result_manager(200, self._resource_pb()) as result:
+            template = template_collection.template
+            result.resource.collection.template.CopyFrom(template)
+            return self.shard(self._template_key(template)).store(
+                template_collection, deadline)
+        return result
+
+    def delete(self, *args, **kwargs):
+        """
+        delete(self, item) -> Result()
+        """
+        deadline = kwargs.pop("deadline", None)
+        with result_manager(204, None) as result:
+            key = self._delete_key(*args, **kwargs)
+            return self.shard(key).delete(*args, deadline=deadline, **kwargs)
+        return result
+
+    def close(self):
+        self.__pool.close()
+
+    ###================================================================
+    ### Abstract properties and methods
+    ###================================================================
+    @abstractmethod
+    def _ResourcePB(self):
+        """
+        ResourcePB() -> protobuf.message.Message()
+
+        The Resource message of the shards
+        """
+
+    @abstractmethod
+    def _template_key(self, template):
+        """
+        _template_key(self, Message()) -> str()
+
+        Return the shard key of a template passed to store()
+        """
+
+    @abstractmethod
+    def _query_key(self, *args, **kwargs):
+        """
+        _query_key(self, *args, **kwargs) -> str()
+
+        Return the shard key for the arguments of query(), None to
+        query every shard
+        """
+
+    @abstractmethod
+    def _delete_key(self, *args, **kwargs):
+        """
+        _delete_key(self, *args, **kwargs) -> str()
+
+        Return the shard key for the arguments of delete()
+        """
+
+    def _item_sort_key(self, item):
+        """
+        _item_sort_key(self, Message()) -> object()
+
+        Return the sort key of an item when self.ordered is True, the
+        items of every shard must already be sorted by this key.  Only
+        needed by ordered services.
+        """
+        raise NotImplementedError()
+
+    def _resource_pb(self):
+        return resolve_class(type(self), "_ResourcePB")()
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __query_shard(self, shard, args, kwargs, options):
+        kwargs = dict(kwargs, deadline=options["deadline"])
+        # Only cached shards know about nocache
+        if options.get("nocache") and isinstance(shard, CachedService):
+            kwargs["nocache"] = True
+        return shard.query(*args, **kwargs)
+
+    def __scatter(self, args, kwargs, options):
+        names = sorted(self.shards)
+        # The item hook of the call is thread local too
+        hook = current_item_hook()
+
+        def query_shard(name):
+            with item_hook_scope(hook):
+                return self.__query_shard(self.shards[name], args, kwargs, options)
+        return zip(names, self.__pool.map(query_shard, names))
+
+    def __gather(self, shard_results):
+        with result_manager(200, self._resource_pb()) as result:
+            try:
+                self.__gather_items(result, shard_results)
+            finally:
+                # The failed shards hold pooled resources too
+                for name, r in shard_results:
+                    r.release()
+        return result
+
+    def __gather_items(self, result, shard_results):
+        failed = [(name, r) for name, r in shard_results
+                  if r.status not in (200, 404)]
+        if failed:
+            name, worst = max(failed, key=lambda pair: pair[1].status)
+            error = worst.resource.collection.error
+            raise Error(
+                worst.status,
+                title=error.title,
+                code=error.code,
+                message="shard {0}: {1}".format(name, error.message))
+
+        # A shard without items answers 404, the collection is only
+        # missing when every shard is
+        found = [r for name, r in shard_results if r.status == 200]
+        if not found:
+            raise Error(404, title="Not Found", code="404", message="resource not found")
+
+        items = result.resource.collection.items
+        for item in self.__merge(found):
+            items.add().CopyFrom(item)
+
+    def __merge(self, results):
+        shard_items = [r.resource.collection.items for r in results]
+        if not self.ordered:
+            return chain.from_iterable(shard_items)
+
+        def decorated(shard, items):
+            for i, item in enumerate(items):
+                yield self._item_sort_key(item), shard, i, item
+
+        return (item for _, _, _, item in heapq.merge(
+            *[decorated(shard, items)
+              for shard, items in enumerate(shard_items)]))
@@ -0,0 +1,281 @@
+"""
+A query result cache shared by the processes of a host
+
+SharedMemoryCache keeps serialized resources in a memory mapped file,
+typically under /dev/shm, so that every worker of a pre-fork server
+shares the same entries:
+
+    cache = SharedMemoryCache("/dev/shm/my-collection", size=64 << 20)
+
+    class MyService(SharedMemoryCachedService, Service):
+        shared_cache = cache
+
+The file is a set associative hash table.  A key hashes to a set of
+`ways` fixed size slots, the least recently used slot of the set is
+evicted.  Each set is locked on its own, with a byte range lock of the
+file between processes and a thread lock within the process.
+
+Writes through the service bump the generation of the cache which
+invalidates every entry at once.
+
+Only the item_hooks of the service, which are the same for every
+call, are cached with the results.  Calls with the hook of a
+service.item_hook_scope(), like the requests of a ServiceView, bypass
+the cache: their items may differ from one call to the next.
+
+The cache is safe across fork: the mapping is shared and the thread
+locks are recreated in the child.
+"""
+from hashlib import md5
+from collection_protobuf.service import (CachedService, PARTIAL_REL,
+                                         current_item_hook)
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = "CPBSHM01"
+# magic, sets, ways, slot size, generation
+HEADER = struct.Struct("<8sIIIQ")
+GENERATION_OFFSET = 20
+GENERATION = struct.Struct("<Q")
+# key hash, last used, generation, key length, value length
+SLOT = struct.Struct("<QdQHI")
+LOCK_STRIPES = 64
+
+
+def _hash(key):
+    h, = struct.unpack("<Q", md5(key).digest()[:8])
+    # 0 marks an empty slot
+    return h or 1
+
+
+class SharedMemoryCache(object):
+    def __init__(self, path, size=16 << 20, slot_size=4096, ways=8):
+        """
+        Open or create the cache file at path.  Values bigger than
+        slot_size minus the key and slot header are not cached.
+        """
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = max(1, size // (slot_size * ways))
+        self.size = HEADER.size + self.sets * ways * slot_size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self.__fd = fd
+        with self.__file_lock(0):
+            if not self.__valid_header():
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.write(fd, HEADER.pack(MAGIC, self.sets, ways, slot_size, 1))
+        self.__map = mmap.mmap(fd, self.size, mmap.MAP_SHARED,
+                               mmap.PROT_READ | mmap.PROT_WRITE)
+        self.__init_locks()
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def get(self, key):
+        """
+        get(self, str()) -> str()
+
+        Return the cached value of key, None on a miss
+        """
+        key_hash = _hash(key)
+        index = key_hash % self.sets
+        generation = self.generation()
+        with self.__set_lock(index):
+            offset = self.__find(index, key_hash, key, generation)
+            if offset is None:
+                return None
+            _, _, _, key_len, value_len = SLOT.unpack_from(self.__map, offset)
+            struct.pack_into("<d", self.__map, offset + 8, time.time())
+            start = offset + SLOT.size + key_len
+            return self.__map[start:start + value_len]
+
+    def set(self, key, value, generation=None):
+        """
+        set(self, str(), str(), int()) -> bool()
+
+        Cache value under key, False if the value is too big.  generation
+        is self.generation() from before value was read, the value is
+        not cached when the cache was cleared since.
+        """
+        if SLOT.size + len(key) + len(value) > self.slot_size:
+            return False
+        key_hash = _hash(key)
+        index = key_hash % self.sets
+        if generation is None:
+            generation = self.generation()
+        elif generation != self.generation():
+            return False
+        with self.__set_lock(index):
+            offset = self.__find(index, key_hash, key, generation)
+            if offset is None:
+                offset = self.__victim(index, generation)
+            SLOT.pack_into(self.__map, offset, key_hash, time.time(),
+                           generation, len(key), len(value))
+            start = offset + SLOT.size
+            self.__map[start:start + len(key)] = key
+            self.__map[start + len(key):start + len(key) + len(value)] = value
+        return True
+
+    def clear(self):
+        """
+        Invalidate every entry
+        """
+        self.__check_fork()
+        with self.__local_lock(0):
+            with self.__file_lock(0):
+                GENERATION.pack_into(self.__map, GENERATION_OFFSET,
+                                     self.generation() + 1)
+
+    def generation(self):
+        return GENERATION.unpack_from(self.__map, GENERATION_OFFSET)[0]
+
+    def close(self):
+        self.__map.close()
+        os.close(self.__fd)
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __valid_header(self):
+        header = os.read(self.__fd, HEADER.size)
+        os.lseek(self.__fd, 0, os.SEEK_SET)
+        if len(header) != HEADER.size:
+            return False
+        magic, sets, ways, slot_size, _ = HEADER.unpack(header)
+        return (magic == MAGIC and sets == self.sets and ways == self.ways
+                and slot_size == self.slot_size
+                and os.fstat(self.__fd).st_size == self.size)
+
+    def __slot_offset(self, index, way):
+        return HEADER.size + (index * self.ways + way) * self.slot_size
+
+    def __find(self, index, key_hash, key, generation):
+        for way in xrange(self.ways):
+            offset = self.__slot_offset(index, way)
+            slot_hash, _, slot_generation, key_len, _ = SLOT.unpack_from(
+                self.__map, offset)
+            if (slot_hash == key_hash and slot_generation == generation
+                and self.__map[offset + SLOT.size:offset + SLOT.size + key_len] == key):
+                return offset
+        return None
+
+    def __victim(self, index, generation):
+        """
+        Return the offset of an empty, stale or least recently used
+        slot of the set
+        """
+        oldest = None
+        for way in xrange(self.ways):
+            offset = self.__slot_offset(index, way)
+            slot_hash, last_used, slot_generation, _, _ = SLOT.unpack_from(
+                self.__map, offset)
+            if not slot_hash or slot_generation != generation:
+                return offset
+            if oldest is None or last_used < oldest[0]:
+                oldest = (last_used, offset)
+        return oldest[1]
+
+    def __init_locks(self):
+        self.__pid = os.getpid()
+        self.__locks = [threading.Lock() for _ in xrange(LOCK_STRIPES)]
+
+    def __check_fork(self):
+        # Locks held by threads of the parent are never released in the
+        # child
+        if os.getpid() != self.__pid:
+            self.__init_locks()
+
+    def __local_lock(self, n):
+        return self.__locks[n % LOCK_STRIPES]
+
+    def __file_lock(self, start):
+        return _FileLock(self.__fd, start)
+
+    def __set_lock(self, index):
+        self.__check_fork()
+        return _Locks(self.__local_lock(index + 1),
+                      self.__file_lock(index + 1))
+
+
+class _FileLock(object):
+    def __init__(self, fd, start):
+        self.fd = fd
+        self.start = start
+
+    def __enter__(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.start)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.start)
+
+
+class _Locks(object):
+    def __init__(self, *locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.__enter__()
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.__exit__(*exc_info)
+
+
+class SharedMemoryCachedService(CachedService):
+    # The SharedMemoryCache() of the service
+    shared_cache = None
+
+    def _cache_key(self, *args, **kwargs):
+        """
+        _cache_key(self, *args, **kwargs) -> str()
+
+        The cache key of the arguments of a query
+        """
+        return repr((type(self).__name__, args, sorted(kwargs.items())))
+
+    def _cached_query(self, *args, **kwargs):
+        if current_item_hook() is not None:
+            return None
+        return self.shared_cache.get(self._cache_key(*args, **kwargs))
+
+    def query(self, *args, **kwargs):
+        # A write during the query clears the cache, the result must
+        # not be cached under the new generation
+        generation = self.shared_cache.generation()
+        result = super(SharedMemoryCachedService, self).query(*args, **kwargs)
+        kwargs.pop("nocache", None)
+        if (not result.cached and result.status == 200
+            and kwargs.get("since") is None
+            and current_item_hook() is None
+            and not any(link.rel == PARTIAL_REL
+                        for link in result.head.collection.links)):
+            cache_kwargs = dict((k, v) for k, v in kwargs.iteritems()
+                                if k != "deadline")
+            self.shared_cache.set(self._cache_key(*args, **cache_kwargs),
+                                  result.serialize(), generation)
+        return result
+
+    def store(self, *args, **kwargs):
+        return self.__invalidate(
+            super(SharedMemoryCachedService, self).store(*args, **kwargs))
+
+    def store_bytes(self, *args, **kwargs):
+        return self.__invalidate(
+            super(SharedMemoryCachedService, self).store_bytes(*args, **kwargs))
+
+    def delete(self, *args, **kwargs):
+        return self.__invalidate(
+            super(SharedMemoryCachedService, self).delete(*args, **kwargs))
+
+    def __invalidate(self, result):
+        if result.status < 300:
+            self.shared_cache.clear()
+        return result
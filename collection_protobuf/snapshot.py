@@ -0,0 +1,268 @@
+"""
+Read-only collections served from a memory mapped snapshot file
+
+    publish_snapshot("/srv/countries.snapshot", CountryService(), values)
+
+    class CountrySnapshotService(SnapshotService):
+        _ResourcePB = "myapp.countries_pb2.CountryResource"
+        snapshot_path = "/srv/countries.snapshot"
+
+The snapshot holds the serialized items sorted by key, each already
+framed as an item of the collection, followed by an index of their
+offsets.  query(key) binary searches the index, query() and
+query(offset=, limit=) slice the framed items; the bytes go to
+Result.tail untouched, no item is parsed.
+
+Items are rendered with the item hooks of the publishing service when
+the snapshot is built, the hooks of the snapshot service are not
+applied to them.
+
+publish_snapshot() writes a new file next to the old one and renames
+it over the path.  The service notices the new file within
+snapshot_check_interval seconds and swaps it in, queries in flight
+keep reading the old mapping.
+"""
+from collection_protobuf.service import Service, Error
+from collection_protobuf.utils import decode_varint, encode_varint, field_tag
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = "CPBSNAP1"
+# magic, item count, index offset
+HEADER = struct.Struct("<8sIQ")
+# record offset, key offset, key length
+ENTRY = struct.Struct("<QQH")
+
+
+def write_snapshot(path, resource_class, items):
+    """
+    write_snapshot(str(), type(), iterator((str(), str()))) -> int()
+
+    Write the (key, serialized item) pairs to a snapshot at path,
+    return the number of items
+    """
+    items = sorted(items)
+    item_tag = field_tag(resource_class().collection, "items")
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        offsets = []
+        for key, byte_string in items:
+            offsets.append(f.tell())
+            f.write(item_tag)
+            f.write(encode_varint(len(byte_string)))
+            f.write(byte_string)
+
+        index_offset = f.tell()
+        key_offset = index_offset + ENTRY.size * len(items)
+        for offset, (key, _) in zip(offsets, items):
+            f.write(ENTRY.pack(offset, key_offset, len(key)))
+            key_offset += len(key)
+        for key, _ in items:
+            f.write(key)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(items), index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    return len(items)
+
+
+def publish_snapshot(path, service, values):
+    """
+    publish_snapshot(str(), Service(), iterator(value())) -> int()
+
+    Render values with service and atomically replace the snapshot at
+    path, return the number of items
+    """
+    resource = service._resource_class()()
+
+    def items():
+        for value in values:
+            resource.Clear()
+            key = service._value_key(value)
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            yield key, service._add_item(resource, value).SerializeToString()
+
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        count = write_snapshot(tmp, service._resource_class(), items())
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return count
+
+
+class Snapshot(object):
+    """
+    A memory mapped snapshot file
+
+    The mapping is unmapped when the snapshot is garbage collected so
+    that a swapped out snapshot stays readable by the queries still
+    using it.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index_offset = HEADER.unpack_from(self.__map)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a snapshot".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def find(self, key):
+        """
+        find(self, str()) -> int()
+
+        The position of key in the snapshot, None if it is missing
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self.key(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def key(self, i):
+        _, offset, length = self.__entry(i)
+        return self.__map[offset:offset + length]
+
+    def records(self, start, stop):
+        """
+        records(self, int(), int()) -> str()
+
+        The framed items from position start to stop
+        """
+        if start >= stop:
+            return ""
+        return self.__map[self.__offset(start):self.__offset(stop)]
+
+    def __offset(self, i):
+        if i >= self.count:
+            return self.index_offset
+        return self.__entry(i)[0]
+
+    def __entry(self, i):
+        return ENTRY.unpack_from(self.__map, self.index_offset + i * ENTRY.size)
+
+
+class Records(object):
+    """
+    The framed items of a query, iterating yields the serialized
+    items one at a time
+    """
+    def __init__(self, byte_string):
+        self.byte_string = byte_string
+
+    def __iter__(self):
+        pos = 0
+        while pos < len(self.byte_string):
+            # skip the field key
+            _, pos = decode_varint(self.byte_string, pos)
+            size, pos = decode_varint(self.byte_string, pos)
+            yield self.byte_string[pos:pos + size]
+            pos += size
+
+
+class SnapshotService(Service):
+    # Path of the snapshot file
+    snapshot_path = None
+    # Seconds between checks for a newly published snapshot
+    snapshot_check_interval = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super(SnapshotService, self).__init__(*args, **kwargs)
+        self.__snapshot = None
+        self.__checked = 0
+        self.__lock = threading.Lock()
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def snapshot(self):
+        """
+        snapshot(self) -> Snapshot()
+
+        The current snapshot, reopened when a new file was published
+        """
+        now = time.time()
+        snapshot = self.__snapshot
+        if snapshot is not None and now - self.__checked < self.snapshot_check_interval:
+            return snapshot
+
+        with self.__lock:
+            self.__checked = now
+            try:
+                stat = os.stat(self.snapshot_path)
+            except OSError:
+                stat = None
+            if stat is not None and (self.__snapshot is None
+                                     or _changed(self.__snapshot.stat, stat)):
+                self.__snapshot = Snapshot(self.snapshot_path)
+            if self.__snapshot is None:
+                raise Error(503,
+                            title="Service Unavailable",
+                            code="503",
+                            message="no snapshot has been published")
+            return self.__snapshot
+
+    ###================================================================
+    ### Service methods
+    ###================================================================
+    def _query(self, key=None, offset=0, limit=None):
+        snapshot = self.snapshot()
+        if key is not None:
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            i = snapshot.find(key)
+            if i is None:
+                return None
+            return Records(snapshot.records(i, i + 1))
+
+        stop = len(snapshot) if limit is None else min(len(snapshot), offset + limit)
+        return Records(snapshot.records(offset, stop))
+
+    def _process_items(self, result, values):
+        if not isinstance(values, Records):
+            return super(SnapshotService, self)._process_items(result, values)
+        head = result.head
+        result.tail += "".join([field_tag(head, "collection"),
+                                encode_varint(len(values.byte_string)),
+                                values.byte_string])
+
+    def _item(self, item, byte_string):
+        item.MergeFromString(byte_string)
+        return item
+
+    def _validate_template(self, template):
+        raise _read_only()
+
+    def _save(self, value):
+        raise _read_only()
+
+    def _delete(self, *args, **kwargs):
+        raise _read_only()
+
+
+def _changed(old, new):
+    return (old.st_ino, old.st_mtime, old.st_size) != (new.st_ino, new.st_mtime, new.st_size)
+
+
+def _read_only():
+    return Error(405,
+                 title="Method Not Allowed",
+                 code="405",
+                 message="the collection is read-only")
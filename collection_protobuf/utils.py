@@ -1,4 +1,27 @@
 
+def import_string(path):
+    """
+    import_string(str()) -> object()
+
+    Import "package.module.Name" and return Name
+    """
+    module_name, _, name = path.rpartition(".")
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+def resolve_class(cls, attr):
+    """
+    resolve_class(type(), str()) -> type()
+
+    Return the class attribute attr of cls, when it is a dotted path
+    the class is imported and stored on cls for the next call
+    """
+    value = getattr(cls, attr)
+    if isinstance(value, basestring):
+        value = import_string(value)
+        setattr(cls, attr, value)
+    return value
+
 def msg(pb, **kwargs):
     for key, item in kwargs.iteritems():
         setattr(pb, key, item)
@@ -7,3 +30,77 @@ def msg(pb, **kwargs):
 def append_msg(repeated, **kwargs):
     pb = repeated.add()
     return msg(pb, **kwargs)
+
+def encode_varint(value):
+    bits = value & 0x7f
+    value >>= 7
+    chunks = []
+    while value:
+        chunks.append(chr(0x80 | bits))
+        bits = value & 0x7f
+        value >>= 7
+    chunks.append(chr(bits))
+    return "".join(chunks)
+
+def field_tag(message, field, wire_type=2):
+    """
+    field_tag(Message(), str(), int()) -> str()
+
+    The encoded key of field, length delimited by default
+    """
+    number = message.DESCRIPTOR.fields_by_name[field].number
+    return encode_varint(number << 3 | wire_type)
+
+def decode_varint(byte_string, pos=0):
+    """
+    decode_varint(str(), int()) -> (int(), int())
+
+    Return the decoded value and the position after it
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(byte_string[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def delimited(byte_string):
+    """
+    Prefix a serialized message with its varint encoded length
+    """
+    return encode_varint(len(byte_string)) + byte_string
+
+def read_delimited(stream):
+    """
+    read_delimited(file()) -> str()
+
+    Read the next length delimited message from stream, return None
+    at the end of the stream
+    """
+    size = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift:
+                raise EOFError("truncated length prefix")
+            return None
+        byte = ord(byte)
+        size |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    byte_string = stream.read(size)
+    if len(byte_string) != size:
+        raise EOFError("truncated message")
+    return byte_string
+
+def iter_delimited(stream):
+    while True:
+        byte_string = read_delimited(stream)
+        if byte_string is None:
+            return
+        yield byte_string
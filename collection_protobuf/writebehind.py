@@ -0,0 +1,208 @@
+"""
+Write-behind buffering for Service.store()
+
+    class CounterService(WriteBehindService, Service):
+        ...
+
+store() validates the template and puts the value into a bounded
+buffer and answers 202 Accepted.  A background thread flushes the
+buffer to self._save_many() when a batch is full or every
+write_behind_interval seconds.  Writes to the same key are coalesced,
+only the latest value is saved.
+
+query() sees the buffered values, self._query_key() tells which key a
+query asks for.  delete() flushes the buffer first so that a buffered
+write does not bring a deleted item back.
+
+Call close() on shutdown to flush the buffer.
+
+self._value_key() and self._query_key() are abstract, implement them
+on the service class itself or on a base listed before the mixin.
+"""
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from collection_protobuf.service import Error
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindService(object):
+    __metaclass__ = ABCMeta
+
+    # Maximum number of buffered values
+    write_behind_size = 10000
+    # Maximum number of values per self._save_many() call
+    write_behind_batch = 100
+    # Seconds between flushes of a partial batch
+    write_behind_interval = 1.0
+    # Seconds store() waits for room in a full buffer
+    write_behind_timeout = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super(WriteBehindService, self).__init__(*args, **kwargs)
+        self.__pending = OrderedDict()
+        self.__inflight = {}
+        self.__cond = threading.Condition()
+        self.__flushing = False
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    ###================================================================
+    ### Public API
+    ###================================================================
+    def flush(self):
+        """
+        Block until every buffered value is flushed
+        """
+        with self.__cond:
+            self.__flushing = True
+            self.__cond.notify_all()
+            while self.__pending or self.__inflight:
+                self.__cond.wait()
+
+    def close(self):
+        """
+        Flush the buffer and stop the background thread
+        """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__thread.join()
+
+    ###================================================================
+    ### Hooks
+    ###================================================================
+    @abstractmethod
+    def _value_key(self, value):
+        """
+        _value_key(self, value()) -> str()
+
+        Return the identity of a value, two values with the same key
+        are versions of the same item
+        """
+
+    @abstractmethod
+    def _query_key(self, *args, **kwargs):
+        """
+        _query_key(self, *args, **kwargs) -> str()
+
+        Return the key a query asks for, None if the query lists the
+        whole collection
+        """
+
+    def _flush_error(self, values, error):
+        """
+        _flush_error(self, [value()], Exception()) -> None
+
+        Called when self._save_many() fails, the values are dropped
+        """
+        log.error("Error flushing {0} values".format(len(values)),
+                  exc_info=True)
+
+    def _store_value(self, value):
+        key = self._value_key(value)
+        timeout_at = time.time() + self.write_behind_timeout
+        with self.__cond:
+            while (not self.__closed
+                   and len(self.__pending) >= self.write_behind_size
+                   and key not in self.__pending):
+                remaining = timeout_at - time.time()
+                if remaining <= 0:
+                    raise Error(503,
+                                title="Service Unavailable",
+                                code="503",
+                                message="write buffer is full")
+                self.__cond.wait(remaining)
+
+            if self.__closed:
+                raise Error(503,
+                            title="Service Unavailable",
+                            code="503",
+                            message="service is shutting down")
+
+            self.__pending.pop(key, None)
+            self.__pending[key] = value
+            if len(self.__pending) >= self.write_behind_batch:
+                self.__cond.notify_all()
+        return 202
+
+    def _store_values(self, values):
+        return [self._store_value(value) for value in values]
+
+    def _query(self, *args, **kwargs):
+        values = super(WriteBehindService, self)._query(*args, **kwargs)
+        with self.__cond:
+            if not (self.__pending or self.__inflight):
+                return values
+            buffered = OrderedDict(self.__inflight)
+            for key, value in self.__pending.iteritems():
+                buffered.pop(key, None)
+                buffered[key] = value
+
+        key = self._query_key(*args, **kwargs)
+        if key is not None:
+            if key in buffered:
+                return [buffered[key]]
+            return values
+        return self.__overlay(values or [], buffered)
+
+    def _delete(self, *args, **kwargs):
+        self.flush()
+        return super(WriteBehindService, self)._delete(*args, **kwargs)
+
+    ###================================================================
+    ### Internal
+    ###================================================================
+    def __overlay(self, values, buffered):
+        for value in values:
+            yield buffered.pop(self._value_key(value), value)
+        for value in buffered.itervalues():
+            yield value
+
+    def __take_batch(self):
+        batch = OrderedDict()
+        while self.__pending and len(batch) < self.write_behind_batch:
+            key, value = self.__pending.popitem(last=False)
+            batch[key] = value
+        self.__inflight.update(batch)
+        # there is room in the buffer again
+        self.__cond.notify_all()
+        return batch
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if (len(self.__pending) < self.write_behind_batch
+                    and not (self.__closed or self.__flushing)):
+                    self.__cond.wait(self.write_behind_interval)
+
+                if not self.__pending:
+                    self.__flushing = False
+                    if self.__closed:
+                        return
+                    continue
+                batch = self.__take_batch()
+
+            self.__save_batch(batch)
+
+            with self.__cond:
+                for key, value in batch.iteritems():
+                    if self.__inflight.get(key) is value:
+                        del self.__inflight[key]
+                self.__cond.notify_all()
+
+    def __save_batch(self, batch):
+        values = batch.values()
+        try:
+            with self._borrow():
+                self._save_many(values)
+        except Exception, e:
+            try:
+                self._flush_error(values, e)
+            except Exception:
+                log.exception("Error reporting flush error")
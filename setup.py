@@ -4,5 +4,10 @@ from setuptools import setup, find_packages
 setup(
     name="collection_protobuf",
     description="An API for implementing collection+protobuf services",
-    packages=find_packages()
+    packages=find_packages(),
+    entry_points={
+        "console_scripts": [
+            "collection-protobuf = collection_protobuf.cli:main",
+        ],
+    },
 )
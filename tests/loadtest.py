@@ -0,0 +1,508 @@
+"""
+Load test a ServiceView and Service over HTTP
+
+    python tests/loadtest.py --rps 200 --duration 10 --processes 4 \\
+        --latency 0.005 --error-rate 0.01 plain itemcache shmcache
+
+For each configuration a local WSGI server is started around a
+ServiceView of a test service of the tests/test.proto schema.  The
+service stores its items in a fake backend with the injected latency
+and error rate.  Client processes then send a mix of GET (list and
+single item), PUT, POST and DELETE requests at the target rate and the
+results of the configurations are reported side by side:
+
+    plain       the service alone
+    itemcache   ItemCachedService, the items are cached serialized
+    shmcache    SharedMemoryCachedService, whole results are cached,
+                the requests bypass it as the view sets per-request hrefs
+    writebehind WriteBehindService, writes are buffered
+
+Keys are picked with a skewed distribution so that the caches have a
+working set.  Needs Django.
+"""
+from collection_protobuf import service
+from collection_protobuf.itemcache import ItemCache, ItemCachedService
+from collection_protobuf.shmcache import SharedMemoryCache, SharedMemoryCachedService
+from collection_protobuf.writebehind import WriteBehindService
+from test_service import TestService, make_template
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+import argparse
+import httplib
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+OPERATIONS = ("list", "get", "put", "post", "delete")
+DEFAULT_MIX = "list=20,get=50,put=10,post=10,delete=10"
+# Upper bounds of the latency histogram buckets in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+###================================================================
+### Fake backend
+###================================================================
+class FakeBackend(object):
+    """
+    Sleeps latency seconds on average on every call and fails with a
+    503 at error_rate
+    """
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self.__lock = threading.Lock()
+
+    def call(self):
+        with self.__lock:
+            self.calls += 1
+            failed = random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if self.latency:
+            time.sleep(random.expovariate(1.0 / self.latency))
+        if failed:
+            raise service.Error(503,
+                                title="Service Unavailable",
+                                code="503",
+                                message="injected backend error")
+
+
+class LoadTestKeys(object):
+    """
+    The key hooks of the mixins, listed before them so that their
+    abstract declarations do not hide these
+    """
+    def _value_key(self, record):
+        return record[0]
+
+    def _delete_key(self, item):
+        return item.pb.key
+
+    def _query_key(self, key=None):
+        return key
+
+
+class LoadTestService(TestService):
+    def __init__(self, backend):
+        super(LoadTestService, self).__init__()
+        self.backend = backend
+        self.__lock = threading.Lock()
+
+    def _query(self, key=None):
+        self.backend.call()
+        with self.__lock:
+            values = super(LoadTestService, self)._query(key)
+            return None if values is None else list(values)
+
+    def _save(self, record):
+        self.backend.call()
+        with self.__lock:
+            return super(LoadTestService, self)._save(record)
+
+    def _delete(self, item):
+        self.backend.call()
+        with self.__lock:
+            return super(LoadTestService, self)._delete(item)
+
+
+class ItemCachedLoadTestService(LoadTestKeys, ItemCachedService, LoadTestService):
+    def __init__(self, backend):
+        super(ItemCachedLoadTestService, self).__init__(backend)
+        self.item_cache = ItemCache()
+
+    def stats(self):
+        return {"hits": self.item_cache.hits, "misses": self.item_cache.misses}
+
+
+class SharedMemoryCachedLoadTestService(SharedMemoryCachedService, LoadTestService):
+    def __init__(self, backend, path):
+        super(SharedMemoryCachedLoadTestService, self).__init__(backend)
+        self.shared_cache = SharedMemoryCache(path, size=4 << 20)
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    def query(self, *args, **kwargs):
+        result = super(SharedMemoryCachedLoadTestService, self).query(*args, **kwargs)
+        with self.__lock:
+            if result.cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return result
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class WriteBehindLoadTestService(LoadTestKeys, WriteBehindService, LoadTestService):
+    pass
+
+
+def make_service(config, backend, tmpdir):
+    if config == "plain":
+        return LoadTestService(backend)
+    if config == "itemcache":
+        return ItemCachedLoadTestService(backend)
+    if config == "shmcache":
+        return SharedMemoryCachedLoadTestService(
+            backend, os.path.join(tmpdir, "shmcache"))
+    if config == "writebehind":
+        return WriteBehindLoadTestService(backend)
+    raise ValueError("unknown configuration {0!r}".format(config))
+
+CONFIGS = ("plain", "itemcache", "shmcache", "writebehind")
+
+
+###================================================================
+### Server
+###================================================================
+urlpatterns = []
+
+
+def setup_django():
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            DEBUG=False,
+            ALLOWED_HOSTS=["*"],
+            ROOT_URLCONF=__name__,
+            MIDDLEWARE=[],
+            MIDDLEWARE_CLASSES=[],
+        )
+        import django
+        if hasattr(django, "setup"):
+            django.setup()
+
+
+def make_view(svc):
+    from django.conf.urls import url
+    from collection_protobuf.django_view import ServiceView, accept
+    import test_pb2
+
+    class LoadTestView(ServiceView):
+        _service = svc
+        _profile_href = "http://example.com/test.proto"
+        _href = "/items/"
+
+        def _item_href(self, item, record):
+            return "/items/" + record[0]
+
+        def _query(self, request, key=None):
+            return self.service.query(key) if key else self.service.query()
+
+        def delete(self, request, key=None):
+            item = test_pb2.TestResource().collection.items.add()
+            item.pb.key = key or ""
+            return self.render(accept(request), self.service.delete(item))
+
+    view = LoadTestView.as_view()
+    urlpatterns[:] = [url(r"^items/(?:(?P<key>[^/]+))?$", view)]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(svc):
+    """
+    Serve svc on a free port in a background thread, return the server
+    """
+    from django.core.wsgi import get_wsgi_application
+    setup_django()
+    make_view(svc)
+    server = make_server("127.0.0.1", 0, get_wsgi_application(),
+                         server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+###================================================================
+### Clients
+###================================================================
+def parse_mix(mix):
+    """
+    parse_mix(str()) -> [(str(), float())]
+
+    The operations and their cumulative probability
+    """
+    weights = []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError("unknown operation {0!r}".format(name))
+        weights.append((name, float(weight)))
+    total = sum(weight for _, weight in weights)
+    cumulative = []
+    acc = 0.0
+    for name, weight in weights:
+        acc += weight / total
+        cumulative.append((name, acc))
+    return cumulative
+
+
+def pick(cumulative):
+    r = random.random()
+    for name, acc in cumulative:
+        if r < acc:
+            return name
+    return cumulative[-1][0]
+
+
+def pick_key(keys):
+    # Skewed towards the first keys, like real traffic
+    return "k{0}".format(min(keys - 1, int(random.paretovariate(1.2)) - 1))
+
+
+def request(port, operation, keys):
+    key = pick_key(keys)
+    if operation == "list":
+        method, path, body = "GET", "/items/", None
+    elif operation == "get":
+        method, path, body = "GET", "/items/" + key, None
+    elif operation == "put":
+        method, path = "PUT", "/items/" + key
+        body = make_template(key, str(random.random()), False).SerializeToString()
+    elif operation == "post":
+        method, path = "POST", "/items/"
+        body = make_template(key, str(random.random()), False).SerializeToString()
+    else:
+        method, path, body = "DELETE", "/items/" + key, None
+
+    connection = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except Exception:
+        return 0
+    finally:
+        connection.close()
+
+
+def client(port, rate, duration, cumulative, keys, threads, queue):
+    """
+    Send rate requests per second for duration seconds, each of the
+    threads sends at its share of the rate on a fixed schedule
+    """
+    results = []
+    lock = threading.Lock()
+    start = time.time()
+
+    def run(offset):
+        interval = threads / rate
+        n = 0
+        while True:
+            at = start + offset * interval / threads + n * interval
+            if at - start >= duration:
+                return
+            delay = at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            operation = pick(cumulative)
+            sent = time.time()
+            status = request(port, operation, keys)
+            # Latency from the scheduled time, requests that fall
+            # behind the schedule count their wait
+            latency = time.time() - min(at, sent)
+            with lock:
+                results.append((operation, status, latency))
+            n += 1
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue.put(results)
+
+
+def drive(port, rps, duration, processes, threads, cumulative, keys):
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+        target=client,
+        args=(port, float(rps) / processes, duration, cumulative, keys,
+              threads, queue))
+        for _ in xrange(processes)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    results = []
+    for _ in workers:
+        results.extend(queue.get())
+    for worker in workers:
+        worker.join()
+    return results, time.time() - start
+
+
+###================================================================
+### Report
+###================================================================
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def histogram(latencies):
+    """
+    histogram([float()]) -> [int()]
+
+    The count of latencies per bucket of BUCKETS, the last one counts
+    the latencies above the last bucket
+    """
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+
+def summarize(results, elapsed, backend, svc):
+    latencies = [latency for _, _, latency in results]
+    statuses = [status for _, status, _ in results]
+    summary = {
+        "requests": len(results),
+        "throughput": len(results) / elapsed,
+        "errors": sum(1 for s in statuses if s == 0 or s >= 500) / float(max(1, len(results))),
+        "client errors": sum(1 for s in statuses if 400 <= s < 500) / float(max(1, len(results))),
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0.0,
+        "backend calls": backend.calls,
+        "histogram": histogram(latencies),
+    }
+    for operation in OPERATIONS:
+        op_latencies = [latency for op, _, latency in results if op == operation]
+        summary[operation + " p99"] = percentile(op_latencies, 99)
+
+    stats = getattr(svc, "stats", None)
+    if stats is not None:
+        counts = stats()
+        lookups = counts["hits"] + counts["misses"]
+        summary["cache hit rate"] = counts["hits"] / float(max(1, lookups))
+    return summary
+
+
+def report(summaries, stream=sys.stdout):
+    configs = [config for config, _ in summaries]
+    rows = [
+        ("requests", "{0:d}"),
+        ("throughput", "{0:.1f}/s"),
+        ("errors", "{0:.2%}"),
+        ("client errors", "{0:.2%}"),
+        ("p50", "ms"),
+        ("p90", "ms"),
+        ("p99", "ms"),
+        ("max", "ms"),
+    ] + [(operation + " p99", "ms") for operation in OPERATIONS] + [
+        ("backend calls", "{0:d}"),
+        ("cache hit rate", "{0:.2%}"),
+    ]
+
+    def cell(summary, name, fmt):
+        if name not in summary:
+            return "-"
+        if fmt == "ms":
+            return "{0:.1f}ms".format(summary[name] * 1000)
+        return fmt.format(summary[name])
+
+    width = max(14, max(len(c) for c in configs) + 2)
+    stream.write("{0:<16}".format("") + "".join(c.rjust(width) for c in configs) + "\n")
+    for name, fmt in rows:
+        stream.write("{0:<16}".format(name) + "".join(
+            cell(summary, name, fmt).rjust(width) for _, summary in summaries) + "\n")
+
+    stream.write("\nlatency histogram\n")
+    bounds = ["<={0}ms".format(b) for b in BUCKETS] + [">{0}ms".format(BUCKETS[-1])]
+    for i, bound in enumerate(bounds):
+        stream.write("{0:<16}".format(bound) + "".join(
+            str(summary["histogram"][i]).rjust(width) for _, summary in summaries) + "\n")
+
+
+def run(config, args):
+    tmpdir = tempfile.mkdtemp()
+    backend = FakeBackend()
+    svc = make_service(config, backend, tmpdir)
+    try:
+        for i in xrange(args.keys):
+            svc.store(make_template("k{0}".format(i), "v", False))
+        # Inject the latency and errors after loading the items
+        backend.latency = args.latency
+        backend.error_rate = args.error_rate
+        backend.calls = backend.errors = 0
+
+        server = serve(svc)
+        try:
+            results, elapsed = drive(server.server_address[1], args.rps,
+                                     args.duration, args.processes,
+                                     args.threads, parse_mix(args.mix),
+                                     args.keys)
+        finally:
+            server.shutdown()
+            server.server_close()
+        return summarize(results, elapsed, backend, svc)
+    finally:
+        close = getattr(svc, "close", None)
+        if close is not None:
+            close()
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a ServiceView")
+    parser.add_argument("configs", nargs="*",
+                        help="configurations to compare, all of {0} by default".format(
+                            ", ".join(CONFIGS)))
+    parser.add_argument("--rps", type=float, default=100)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8,
+                        help="concurrent requests per process")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weights of " + ", ".join(OPERATIONS))
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="mean backend latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    for config in args.configs:
+        if config not in CONFIGS:
+            parser.error("unknown configuration {0!r}".format(config))
+    # test_service logs every query at DEBUG
+    logging.getLogger().setLevel(logging.WARNING)
+
+    summaries = []
+    for config in args.configs or CONFIGS:
+        sys.stderr.write("running {0}\n".format(config))
+        summaries.append((config, run(config, args)))
+    report(summaries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+from collection_protobuf.admission import Limiter
+
+
+def test_fixed_limit():
+    limiter = Limiter(limit=2)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release(10.0)
+    assert limiter.acquire()
+    assert limiter.stats() == {
+        "limit": 2, "in_flight": 2, "admitted": 3, "shed": 1}
+
+
+def test_slow_requests_decrease_limit():
+    limiter = Limiter(limit=10, target_latency=0.1, backoff=0.5)
+    limiter.acquire()
+    limiter.release(1.0)
+    assert limiter.stats()["limit"] == 5
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0, dropped=True)
+    assert limiter.stats()["limit"] == 1
+
+
+def test_fast_requests_increase_limit():
+    limiter = Limiter(limit=2, max_limit=4, target_latency=0.1)
+    for _ in range(50):
+        admitted = 0
+        while limiter.acquire():
+            admitted += 1
+        for _ in range(admitted):
+            limiter.release(0.01)
+    assert limiter.stats()["limit"] == 4
+
+
+def test_decrease_once_per_window():
+    limiter = Limiter(limit=10, target_latency=0.1, backoff=0.5)
+    for _ in range(3):
+        limiter.acquire()
+    # the three requests were in flight together
+    for _ in range(3):
+        limiter.release(1.0)
+    assert limiter.stats()["limit"] == 5
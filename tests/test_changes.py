@@ -0,0 +1,76 @@
+from collection_protobuf import changes, service
+from collection_protobuf.utils import delimited, iter_delimited
+from StringIO import StringIO
+import shutil
+import tempfile
+import pytest
+import test_pb2
+from test_service import TestService, make_template
+
+
+class ChangesTestService(TestService):
+    def _deleted_value(self, item):
+        return (item.pb.key, "")
+
+
+def parse_item(event):
+    item = test_pb2.TestItem()
+    item.ParseFromString(event)
+    return item
+
+
+def test_store_and_delete_publish():
+    svc = ChangesTestService()
+    svc.changes = changes.Broker()
+    subscription = svc.changes.subscribe()
+
+    svc.store(make_template("a", "1", False))
+    svc.store(make_template("", "1", False))  # invalid, not published
+    item = svc._ResourcePB().collection.items.add()
+    item.pb.key = "a"
+    svc.delete(item)
+    svc.delete(item)  # 404, not published
+
+    events = [parse_item(e) for e in subscription.drain(0, 10)]
+    assert [(i.pb.key, service.is_tombstone(i)) for i in events] == [
+        ("a", False), ("a", True)]
+
+
+def test_overflow():
+    broker = changes.Broker()
+    subscription = broker.subscribe(maxsize=2)
+    for i in range(3):
+        broker.publish(str(i))
+
+    assert subscription.get() == "0"
+    assert subscription.get() == "1"
+    with pytest.raises(changes.Overflow):
+        subscription.get()
+
+
+def test_unsubscribe():
+    broker = changes.Broker()
+    with broker.subscribe() as subscription:
+        pass
+    broker.publish("event")
+    assert subscription.get(0) is None
+
+
+def test_unix_socket_backend():
+    directory = tempfile.mkdtemp()
+    try:
+        publisher = changes.Broker(changes.UnixSocketBackend(directory))
+        listener = changes.Broker(changes.UnixSocketBackend(directory))
+        subscription = listener.subscribe()
+        publisher.publish("event")
+        assert subscription.get(5) == "event"
+        publisher.close()
+        listener.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_delimited():
+    messages = ["", "a", "b" * 300]
+    stream = StringIO("".join(delimited(m) for m in messages))
+    assert list(iter_delimited(stream)) == messages
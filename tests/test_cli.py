@@ -0,0 +1,131 @@
+from collection_protobuf import cli, service
+from collection_protobuf.writebehind import WriteBehindService
+from test_service import TestService, make_template
+import os
+import shutil
+import tempfile
+import pytest
+
+DATA = {}
+
+
+class CliTestService(TestService):
+    """
+    Every instance shares DATA
+    """
+    batches = []
+
+    def __init__(self):
+        super(CliTestService, self).__init__()
+        self._TestService__data = DATA
+
+    def _query(self, key=None):
+        # export in key order
+        return sorted(super(CliTestService, self)._query(key))
+
+    def _save_many(self, records):
+        if any(value == "fail" for key, value in records):
+            raise service.Error(503, title="Unavailable")
+        self.batches.append(len(records))
+        return super(CliTestService, self)._save_many(records)
+
+
+class WriteBehindCliTestService(WriteBehindService, CliTestService):
+    # Only flushes save the buffer
+    write_behind_interval = 60
+    checkpoints = []
+
+    def _value_key(self, record):
+        return record[0]
+
+    def _query_key(self, key=None):
+        return key
+
+    def _save_many(self, records):
+        self.checkpoints.append((cli.Checkpoint(self.checkpoint_path).load(), len(DATA)))
+        return super(WriteBehindCliTestService, self)._save_many(records)
+
+
+SERVICE = "tests.test_cli.CliTestService"
+
+
+@pytest.fixture
+def directory(request):
+    DATA.clear()
+    del CliTestService.batches[:]
+    directory = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(directory))
+    return directory
+
+
+def fill(count):
+    svc = CliTestService()
+    for i in xrange(count):
+        svc.store(make_template("key{0:03d}".format(i), str(i), False))
+
+
+@pytest.mark.parametrize("compress", ["none", "gzip", "bz2"])
+def test_export_import(directory, compress):
+    fill(25)
+    expected = dict(DATA)
+    path = os.path.join(directory, "export")
+
+    assert cli.main(["export", SERVICE, "-o", path, "--compress", compress]) == 0
+    DATA.clear()
+    assert cli.main(["import", SERVICE, path, "--batch-size", "10",
+                     "--workers", "2"]) == 0
+    assert DATA == expected
+    assert sorted(CliTestService.batches) == [5, 10, 10]
+
+
+def test_resume_from_checkpoint(directory):
+    fill(30)
+    DATA["key015"] = "fail"
+    path = os.path.join(directory, "export")
+    checkpoint = os.path.join(directory, "checkpoint")
+    cli.main(["export", SERVICE, "-o", path])
+
+    DATA.clear()
+    assert cli.main(["import", SERVICE, path, "--batch-size", "10",
+                     "--workers", "1", "--checkpoint", checkpoint]) == 1
+    assert cli.Checkpoint(checkpoint).load() == 10
+    # The batch read ahead of the failing one may be stored too
+    assert all("key{0:03d}".format(i) in DATA for i in range(10))
+    assert not any("key{0:03d}".format(i) in DATA for i in range(10, 20))
+    del CliTestService.batches[:]
+
+    # Fix the failing item and resume after the first batch
+    with open(path, "rb") as stream:
+        items = list(cli.iter_delimited(stream))
+    with open(path, "wb") as stream:
+        for byte_string in items:
+            stream.write(cli.delimited(byte_string.replace("fail", "fine")))
+
+    assert cli.main(["import", SERVICE, path, "--batch-size", "10",
+                     "--checkpoint", checkpoint]) == 0
+    assert cli.Checkpoint(checkpoint).load() == 30
+    assert len(DATA) == 30
+    assert CliTestService.batches == [10, 10]
+
+
+def test_compress_requires_output(directory):
+    with pytest.raises(SystemExit):
+        cli.main(["export", SERVICE, "--compress", "gzip"])
+
+
+def test_import_flushes_buffered_writes(directory):
+    fill(25)
+    expected = dict(DATA)
+    path = os.path.join(directory, "export")
+    checkpoint = os.path.join(directory, "checkpoint")
+    cli.main(["export", SERVICE, "-o", path])
+
+    DATA.clear()
+    WriteBehindCliTestService.checkpoint_path = checkpoint
+    assert cli.main(["import", "tests.test_cli.WriteBehindCliTestService", path,
+                     "--batch-size", "10", "--workers", "1",
+                     "--checkpoint", checkpoint]) == 0
+    assert DATA == expected
+    # the checkpoint never moved past the saved items
+    assert all(done <= saved for done, saved in WriteBehindCliTestService.checkpoints)
+    assert cli.Checkpoint(checkpoint).load() == 25
@@ -0,0 +1,126 @@
+from cStringIO import StringIO
+from collection_protobuf.composite import (CompositeService, LocalCache, SubQuery,
+                                           envelope, iter_envelope)
+from collection_protobuf import service
+from test_service import TestService, make_template
+import pytest
+import threading
+import time
+import test_pb2
+
+
+class BlockingTestService(TestService):
+    def __init__(self):
+        super(BlockingTestService, self).__init__()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def _query(self, key=None):
+        self.calls += 1
+        self.release.wait(5)
+        return super(BlockingTestService, self)._query(key)
+
+
+def make_service(cls=TestService, keys="ab"):
+    svc = cls()
+    for key in keys:
+        svc.store(make_template(key, key.upper(), False))
+    return svc
+
+
+def keys(byte_string):
+    resource = test_pb2.TestResource()
+    resource.ParseFromString(byte_string)
+    return sorted(item.pb.key for item in resource.collection.items)
+
+
+def test_fan_out():
+    composite = CompositeService({"letters": make_service(),
+                                  "more": make_service(keys="xyz")})
+    entries = dict((name, (status, body)) for name, status, body in composite.query([
+        SubQuery("all", "letters"),
+        SubQuery("one", "letters", ("b",)),
+        SubQuery("missing", "letters", ("z",)),
+        SubQuery("more", "more"),
+        SubQuery("unknown", "nope"),
+        SubQuery("bad", "letters", kwargs={"foo": "1"})]))
+    composite.close()
+
+    assert entries["all"][0] == 200 and keys(entries["all"][1]) == ["a", "b"]
+    assert entries["one"][0] == 200 and keys(entries["one"][1]) == ["b"]
+    assert entries["missing"][0] == 404
+    assert keys(entries["more"][1]) == ["x", "y", "z"]
+    assert entries["unknown"] == (404, "")
+    resource = test_pb2.TestResource()
+    resource.ParseFromString(entries["bad"][1])
+    assert (entries["bad"][0], resource.collection.error.code) == (400, "400")
+
+    with pytest.raises(service.Error):
+        list(composite.query([SubQuery("a", "letters"), SubQuery("a", "more")]))
+
+
+def test_slow_sub_query_does_not_block_the_others():
+    slow = make_service(BlockingTestService)
+    composite = CompositeService({"fast": make_service(), "slow": slow})
+    start = time.time()
+    results = composite.query([SubQuery("slow", "slow", timeout=0.2),
+                               SubQuery("fast", "fast")])
+
+    name, status, _ = next(results)
+    assert (name, status) == ("fast", 200)
+    assert time.time() - start < 0.2
+
+    name, status, body = next(results)
+    assert (name, status) == ("slow", 504)
+    resource = test_pb2.TestResource()
+    resource.ParseFromString(body)
+    assert resource.collection.error.code == "504"
+    assert list(results) == []
+
+    slow.release.set()
+    composite.close()
+
+
+def test_cache():
+    svc = make_service(BlockingTestService)
+    svc.release.set()
+    composite = CompositeService({"letters": svc}, cache=LocalCache(ttl=60))
+    for _ in range(3):
+        (_, status, body), = composite.query([SubQuery("all", "letters")])
+        assert keys(body) == ["a", "b"]
+    assert svc.calls == 1
+
+    list(composite.query([SubQuery("all", "letters", nocache=True)]))
+    list(composite.query([SubQuery("one", "letters", ("a",))]))
+    assert svc.calls == 3
+    composite.close()
+
+    cache = LocalCache(size=1, ttl=0)
+    cache.set("a", "1")
+    assert cache.get("a") is None
+    cache.ttl = 60
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert (cache.get("a"), cache.get("b")) == (None, "2")
+
+    # least recently used, not least recently set
+    cache = LocalCache(size=2, ttl=60)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+
+    # expired entries do not pile up
+    cache = LocalCache(size=2, ttl=-1)
+    for _ in range(100):
+        cache.set("a", "1")
+        assert cache.get("a") is None
+    assert len(cache._LocalCache__entries) == 0
+
+
+def test_envelope():
+    entries = [("a", 200, "resource"), (u"b\xe9", 504, ""), ("c", 404, "x" * 300)]
+    stream = StringIO("".join(envelope(entries)))
+    assert list(iter_envelope(stream)) == [
+        ("a", 200, "resource"), ("b\xc3\xa9", 504, ""), ("c", 404, "x" * 300)]
@@ -0,0 +1,285 @@
+import pytest
+django = pytest.importorskip("django")
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(DEBUG=False, ALLOWED_HOSTS=["*"])
+    django.setup()
+
+from django.test import RequestFactory
+from collection_protobuf import changes, django_view, service
+from collection_protobuf.admission import Limiter
+from collection_protobuf.composite import CompositeService, iter_envelope
+from collection_protobuf.profiling import Profiler, RingBufferSink
+from collection_protobuf.utils import iter_delimited
+from test_service import ChangesTestService, TestService, make_template
+from test_filters import make_service as make_indexed
+from StringIO import StringIO
+import json
+import time
+import test_pb2
+
+factory = RequestFactory()
+
+
+class TestChangesView(django_view.ChangesView):
+    broker = changes.Broker()
+    poll_timeout = 0
+
+    @property
+    def _broker(self):
+        return self.broker
+
+
+def poll(cursor=None):
+    request = factory.get("/changes", {"cursor": cursor} if cursor else {})
+    response = TestChangesView.as_view()(request)
+    events = list(iter_delimited(StringIO(response.content)))
+    return response.status_code, response.get("x-changes-cursor"), events
+
+
+def test_long_poll_keeps_events_between_polls():
+    broker = TestChangesView.broker
+    status, cursor, events = poll()
+    assert (status, events) == (204, [])
+
+    broker.publish("a")
+    broker.publish("b")
+    assert poll(cursor) == (200, cursor, ["a", "b"])
+    assert poll(cursor) == (204, cursor, [])
+
+    assert poll("unknown")[0] == 410
+
+
+def test_long_poll_overflow_and_expiry():
+    broker = TestChangesView.broker
+    _, cursor, _ = poll()
+    for i in range(TestChangesView.queue_size + 1):
+        broker.publish(str(i))
+    assert poll(cursor)[0] == 200
+    assert poll(cursor)[0] == 410
+    # the cursor is gone after the overflow
+    assert poll(cursor)[0] == 410
+
+    _, cursor, _ = poll()
+    broker.cursor_ttl = -1
+    try:
+        assert poll(cursor)[0] == 410
+    finally:
+        broker.cursor_ttl = 60
+
+
+def test_event_stream_subscribes_when_iterated():
+    broker = changes.Broker()
+
+    class StreamView(TestChangesView):
+        poll_timeout = 0
+
+        @property
+        def _broker(self):
+            return broker
+
+    request = factory.get("/changes", HTTP_ACCEPT="text/event-stream")
+    response = StreamView.as_view()(request)
+    # not subscribed until the response is sent
+    broker.publish("missed")
+    stream = iter(response.streaming_content)
+    assert next(stream) == ":\n\n"
+    broker.publish("event")
+    assert next(stream) == "data: ZXZlbnQ=\n\n"
+    response.close()
+
+
+class TestServiceView(django_view.ServiceView):
+    _service = TestService()
+    _profile_href = "http://example.com/test.proto"
+    _href = "/items/"
+
+    def _item_href(self, item, record):
+        return "/items/{0}?user={1}".format(record[0], self.request.GET["user"])
+
+    def _query(self, request, key=None):
+        return self.service.query(key) if key else self.service.query()
+
+    def delete(self, request, key=None):
+        item = test_pb2.TestResource().collection.items.add()
+        item.pb.key = key or ""
+        return self.render(django_view.accept(request), self.service.delete(item))
+
+
+def test_item_href_is_per_request():
+    TestServiceView._service.store(make_template("a", "A", False))
+    for user in ("alice", "bob"):
+        response = TestServiceView.as_view()(factory.get("/items/a", {"user": user}), key="a")
+        resource = test_pb2.TestResource()
+        resource.ParseFromString(response.content)
+        assert resource.collection.items[0].href == "/items/a?user=" + user
+    # the view does not leave hooks behind on the shared service
+    assert TestServiceView._service.item_hooks.hooks == []
+
+
+def test_delete_without_resource_renders_bare_status():
+    response = TestServiceView.as_view()(factory.delete("/items/missing"), key="missing")
+    assert (response.status_code, response.content) == (404, "")
+
+
+def test_shed_body_per_view_class():
+    class ShedView(TestServiceView):
+        read_limiter = Limiter(limit=0)
+
+    class OtherShedView(ShedView):
+        _href = "/other/"
+
+    bodies = []
+    for view in (ShedView, OtherShedView):
+        response = view.as_view()(factory.get("/items/", {"user": "alice"}))
+        assert response.status_code == 503
+        resource = test_pb2.TestResource()
+        resource.ParseFromString(response.content)
+        bodies.append(resource.collection.href)
+    assert bodies == ["/items/", "/other/"]
+
+
+class CountingPool(service.MessagePool):
+    def __init__(self, factory):
+        super(CountingPool, self).__init__(factory)
+        self.in_use = 0
+
+    def acquire(self):
+        self.in_use += 1
+        return super(CountingPool, self).acquire()
+
+    def release(self, pb):
+        self.in_use -= 1
+        return super(CountingPool, self).release(pb)
+
+
+def test_put_releases_the_query_result():
+    svc = TestService()
+    svc.store(make_template("a", "A", False))
+    svc.resource_pool = CountingPool(test_pb2.TestResource)
+
+    class PooledView(TestServiceView):
+        _service = svc
+
+    body = make_template("a", "B", False).SerializeToString()
+    request = factory.put("/items/a?user=alice", body,
+                          content_type="application/vnd.collection+protobuf")
+    assert PooledView.as_view()(request, key="a").status_code == 200
+    assert svc.resource_pool.in_use == 0
+
+
+class FilteredView(django_view.ServiceView):
+    _service = make_indexed()
+    _profile_href = "http://example.com/test.proto"
+    _href = "/items/"
+
+    def _item_href(self, item, record):
+        return "/items/" + record[0]
+
+    def _query(self, request, key=None):
+        return self.service.query(filters=self._filters(request))
+
+
+def get_keys(view, path, params=None, **headers):
+    response = view.as_view()(factory.get(path, params or {}, **headers))
+    resource = test_pb2.TestResource()
+    resource.ParseFromString(response.content)
+    return response.status_code, [item.pb.key for item in resource.collection.items]
+
+
+def test_query_filters():
+    assert get_keys(FilteredView, "/items/", {"pb.value": "odd"}) == (200, ["a", "c"])
+    assert get_keys(FilteredView, "/items/", {"pb.key__gte": "c"}) == (200, ["c", "d"])
+    status, _ = get_keys(FilteredView, "/items/", {"pb.nope": "1"})
+    assert status == 400
+
+
+def test_profiled_request():
+    sink = RingBufferSink()
+
+    class ProfiledView(TestServiceView):
+        profiler = Profiler(sink, token="secret")
+
+    class TestProfileView(django_view.ProfileView):
+        _sink = sink
+
+    request = factory.get("/items/", {"user": "alice"})
+    assert "x-profile-id" not in ProfiledView.as_view()(request)
+
+    request = factory.get("/items/", {"user": "alice"}, HTTP_X_PROFILE="secret")
+    profile_id = ProfiledView.as_view()(request)["x-profile-id"]
+    reports = json.loads(TestProfileView.as_view()(factory.get("/profiles")).content)
+    assert [report["id"] for report in reports] == [profile_id]
+
+    response = TestProfileView.as_view()(factory.get("/profiles", {"id": profile_id}))
+    assert response.content.startswith("GET /items/ ")
+    assert "_query" in response.content
+    assert TestProfileView.as_view()(factory.get("/profiles", {"id": "nope"})).status_code == 404
+
+
+def test_composite_view():
+    letters = TestService()
+    for key in "ab":
+        letters.store(make_template(key, key.upper(), False))
+
+    class TestCompositeView(django_view.CompositeView):
+        _composite = CompositeService({"letters": letters})
+
+    request = factory.get("/dashboard", {"q": ["all:letters", "one:letters?key=b",
+                                               "bad:letters?foo=1", "none:nope"]})
+    response = TestCompositeView.as_view()(request)
+    entries = list(iter_envelope(StringIO("".join(response.streaming_content))))
+    statuses = dict((name, status) for name, status, _ in entries)
+    assert statuses == {"all": 200, "one": 200, "bad": 400, "none": 404}
+    one = test_pb2.TestResource()
+    one.ParseFromString(dict((name, body) for name, _, body in entries)["one"])
+    assert [item.pb.key for item in one.collection.items] == ["b"]
+
+    for q in (["malformed"], ["a:letters", "a:letters"]):
+        assert TestCompositeView.as_view()(factory.get("/dashboard", {"q": q})).status_code == 400
+    TestCompositeView._composite.close()
+
+
+def test_delta_queries():
+    class DeltaView(TestServiceView):
+        _service = ChangesTestService()
+
+    svc = DeltaView._service
+    svc.store(make_template("a", "1", False))
+    response = DeltaView.as_view()(factory.get("/items/", {"user": "alice"}))
+    resource = test_pb2.TestResource()
+    resource.ParseFromString(response.content)
+    link, = [l.href for l in resource.collection.links if l.rel == service.CHANGES_REL]
+    assert link == "/items/?since=1"
+
+    svc.store(make_template("b", "2", False))
+    assert get_keys(DeltaView, "/items/", {"since": "1", "user": "alice"}) == (200, ["b"])
+    assert get_keys(DeltaView, "/items/", {"user": "alice"},
+                    HTTP_X_COLLECTION_SINCE="1") == (200, ["b"])
+    assert get_keys(DeltaView, "/items/", {"since": "9", "user": "alice"})[0] == 410
+
+
+class SlowTestService(TestService):
+    def _query(self, key=None):
+        time.sleep(0.05)
+        return super(SlowTestService, self)._query(key)
+
+
+def test_request_timeout():
+    class SlowView(TestServiceView):
+        _service = SlowTestService()
+
+    SlowView._service.store(make_template("a", "1", False))
+    assert get_keys(SlowView, "/items/", {"user": "alice"},
+                    HTTP_X_REQUEST_TIMEOUT="5") == (200, ["a"])
+    response = SlowView.as_view()(factory.get("/items/", {"user": "alice"},
+                                              HTTP_X_REQUEST_TIMEOUT="0.01"))
+    resource = test_pb2.TestResource()
+    resource.ParseFromString(response.content)
+    assert (response.status_code, resource.collection.error.code) == (504, "504")
+
+    # the view timeout bounds the client's
+    SlowView.timeout = 0.01
+    assert get_keys(SlowView, "/items/", {"user": "alice"},
+                    HTTP_X_REQUEST_TIMEOUT="5")[0] == 504
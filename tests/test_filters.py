@@ -0,0 +1,76 @@
+from collection_protobuf.filters import (Filter, HashIndex, IndexedService,
+                                         SortedIndex, parse_filters)
+from collection_protobuf import service
+from test_service import TestService, make_template
+import pytest
+import test_pb2
+
+
+class IndexedTestService(IndexedService):
+    _ResourcePB = test_pb2.TestResource
+    _validate_template = TestService._validate_template.im_func
+    _item = TestService._item.im_func
+    indexes = [HashIndex("pb.value"), SortedIndex("pb.key")]
+
+    def _value_key(self, record):
+        return record[0]
+
+    def _delete_key(self, item):
+        return item.pb.key
+
+
+def keys(result):
+    assert result.status == 200, result.resource.collection.error
+    return [item.pb.key for item in result.resource.collection.items]
+
+
+def make_service():
+    svc = IndexedTestService()
+    for key, value in [("d", "even"), ("a", "odd"), ("c", "odd"), ("b", "even")]:
+        svc.store(make_template(key, value, False))
+    return svc
+
+
+def test_filters():
+    svc = make_service()
+    assert keys(svc.query()) == ["d", "a", "c", "b"]
+    assert keys(svc.query("c")) == ["c"]
+    assert svc.query("z").status == 404
+
+    assert keys(svc.query(filters=[Filter("pb.value", "eq", "odd")])) == ["a", "c"]
+    assert keys(svc.query(filters=[Filter("pb.key", "gte", "b")])) == ["b", "c", "d"]
+    assert keys(svc.query(filters=[Filter("pb.key", "lt", "c")])) == ["a", "b"]
+    assert keys(svc.query(filters=[Filter("pb.key", "gt", "a"),
+                                   Filter("pb.key", "lte", "c"),
+                                   Filter("pb.value", "eq", "even")])) == ["b"]
+    assert keys(svc.query(filters=[Filter("pb.value", "eq", "none")])) == []
+
+    # hash indexes only answer equality
+    assert svc.query(filters=[Filter("pb.value", "gt", "a")]).status == 400
+
+
+def test_indexes_follow_writes():
+    svc = make_service()
+    svc.store(make_template("a", "even", False))
+    assert keys(svc.query(filters=[Filter("pb.value", "eq", "odd")])) == ["c"]
+    assert keys(svc.query(filters=[Filter("pb.value", "eq", "even")])) == ["d", "b", "a"]
+
+    item = test_pb2.TestResource().collection.items.add()
+    item.pb.key = "b"
+    assert svc.delete(item).status == 204
+    assert svc.delete(item).status == 404
+    assert keys(svc.query(filters=[Filter("pb.key", "lte", "c")])) == ["a", "c"]
+    assert keys(svc.query(filters=[Filter("pb.value", "eq", "even")])) == ["d", "a"]
+
+
+def test_advertised_queries():
+    queries = make_service().query().resource.collection.queries
+    assert [(q.rel, q.name) for q in queries] == [("search", "filter")]
+    assert [d.name for d in queries[0].data] == [
+        "pb.value", "pb.key", "pb.key__lt", "pb.key__lte", "pb.key__gt", "pb.key__gte"]
+
+    assert parse_filters([("pb.key__gt", "a"), ("pb.value", "odd")], queries) == [
+        Filter("pb.key", "gt", "a"), Filter("pb.value", "eq", "odd")]
+    with pytest.raises(service.Error) as e:
+        parse_filters([("pb.value__gt", "a")], queries)
+    assert e.value.status == 400
@@ -0,0 +1,78 @@
+"""
+Import time of collection_protobuf.service
+
+Run as a script to print the import times:
+
+    python tests/test_import_time.py
+
+The import time depends on the machine, the test only catches gross
+regressions by default.  IMPORT_TIME_LIMIT sets a tighter bound in
+seconds:
+
+    IMPORT_TIME_LIMIT=0.05 py.test tests/test_import_time.py
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules collection_protobuf.service must not import
+HEAVY = ["django", "google.protobuf", "multiprocessing", "socket", "test_pb2"]
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print elapsed
+print " ".join(sys.modules)
+"""
+
+def import_time(module):
+    """
+    import_time(str()) -> (float(), set(str()))
+
+    Import module in a fresh interpreter, return the seconds it took
+    and the modules that were imported
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, "tests")]))
+    output = subprocess.check_output(
+        [sys.executable, "-c", SCRIPT.format(module=module)],
+        cwd=ROOT, env=env)
+    elapsed, modules = output.splitlines()
+    return float(elapsed), set(modules.split())
+
+
+def test_service_imports_cheaply():
+    _, modules = import_time("collection_protobuf.service")
+    assert not [m for m in HEAVY if m in modules]
+
+
+def test_service_import_time():
+    elapsed, _ = min(import_time("collection_protobuf.service")
+                     for _ in range(3))
+    assert elapsed < float(os.environ.get("IMPORT_TIME_LIMIT", 0.5))
+
+
+def test_resource_pb_is_resolved_lazily():
+    script = """
+import sys
+from collection_protobuf import service
+class Lazy(service.Service):
+    _ResourcePB = "test_pb2.TestResource"
+    _query = _validate_template = _save = _delete = _item = None
+s = Lazy()
+assert "test_pb2" not in sys.modules
+assert s._resource_pb().DESCRIPTOR.name == "TestResource"
+assert "test_pb2" in sys.modules
+"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, "tests")]))
+    subprocess.check_call([sys.executable, "-c", script], cwd=ROOT, env=env)
+
+
+if __name__ == "__main__":
+    for module in ["collection_protobuf.service", "test_pb2"]:
+        elapsed, modules = min(import_time(module) for _ in range(5))
+        print "{0:<30} {1:8.2f}ms {2:4d} modules".format(
+            module, elapsed * 1000, len(modules))
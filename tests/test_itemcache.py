@@ -0,0 +1,97 @@
+from collection_protobuf import service
+from collection_protobuf.itemcache import ItemCache, ItemCachedService
+from test_service import TestService, make_template
+import test_pb2
+
+
+class ItemCachedTestService(ItemCachedService, TestService):
+    def __init__(self):
+        super(ItemCachedTestService, self).__init__()
+        self.item_cache = ItemCache()
+        self.rendered = []
+
+    def _value_key(self, record):
+        return record[0]
+
+    def _delete_key(self, item):
+        return item.pb.key
+
+    def _item(self, item, record):
+        self.rendered.append(record[0])
+        return super(ItemCachedTestService, self)._item(item, record)
+
+
+def items(resource):
+    return sorted((i.pb.key, i.pb.value) for i in resource.collection.items)
+
+
+def test_only_changed_items_are_rendered():
+    svc = ItemCachedTestService()
+    svc.item_hooks.add(lambda item, record: setattr(item, "href", "/" + record[0]))
+    for key in "abc":
+        svc.store(make_template(key, key, False))
+
+    result = svc.query()
+    assert sorted(svc.rendered) == ["a", "b", "c"]
+    expected = items(result.resource)
+
+    # served from the item cache without parsing
+    del svc.rendered[:]
+    result = svc.query()
+    assert svc.rendered == []
+    assert len(result.head.collection.items) == 0
+    parsed = test_pb2.TestResource()
+    parsed.ParseFromString(result.serialize())
+    assert items(parsed) == expected
+    assert sorted(i.href for i in result.resource.collection.items) == ["/a", "/b", "/c"]
+
+    svc.store(make_template("b", "B", False))
+    result = svc.query()
+    assert svc.rendered == ["b"]
+    assert ("b", "B") in items(result.resource)
+
+    item = test_pb2.TestResource().collection.items.add()
+    item.pb.key = "a"
+    svc.delete(item)
+    del svc.rendered[:]
+    assert items(svc.query().resource) == [("b", "B"), ("c", "c")]
+    assert svc.rendered == []
+
+
+def test_lru():
+    cache = ItemCache(size=2)
+    cache.set("a", None, "1")
+    cache.set("b", None, "2")
+    cache.get("a", None)
+    cache.set("c", None, "3")
+    assert cache.get("b", None) is None
+    assert cache.get("a", None) == "1"
+    assert cache.get("a", 2) is None
+
+
+class RacingTestService(ItemCachedTestService):
+    def _save(self, record):
+        # a query running while the write is in flight caches the old item
+        self.query()
+        return super(RacingTestService, self)._save(record)
+
+
+def test_store_invalidates_after_the_write():
+    svc = RacingTestService()
+    svc.store(make_template("a", "1", False))
+    svc.store(make_template("a", "2", False))
+    assert items(svc.query().resource) == [("a", "2")]
+
+
+def test_call_hook_is_not_cached():
+    svc = ItemCachedTestService()
+    svc.store(make_template("a", "A", False))
+    for user in ("alice", "bob"):
+        hook = lambda item, record, user=user: setattr(item, "href", "/a?user=" + user)
+        with service.item_hook_scope(hook):
+            resource = svc.query().resource
+        assert [i.href for i in resource.collection.items] == ["/a?user=" + user]
+        assert items(resource) == [("a", "A")]
+    assert svc.item_cache.hits == 1
+    # no hook, no href
+    assert svc.query().resource.collection.items[0].href == ""
@@ -0,0 +1,85 @@
+from collection_protobuf.profiling import (DirectorySink, Profiler,
+                                           RingBufferSink, current_profile)
+from test_service import TestService, make_template
+import json
+import os
+import pstats
+import pytest
+
+
+class ProfiledTestService(TestService):
+    def __init__(self, profiler):
+        super(ProfiledTestService, self).__init__()
+        self.profiler = profiler
+        self.item_hooks.add(lambda item, record: setattr(item, "href", "/" + record[0]))
+        for key in "abc":
+            self.store(make_template(key, key, False))
+
+
+def test_sampled_queries_are_profiled():
+    sink = RingBufferSink(size=2)
+    svc = ProfiledTestService(Profiler(sink, rate=1.0))
+    result = svc.query()
+    result.serialize()
+    assert current_profile() is None
+
+    report, = sink.reports()
+    assert report["label"] == "ProfiledTestService.query"
+    assert sorted(report["phases"]) == ["_item", "_query", "hooks"]
+    assert report["elapsed"] >= sum(report["phases"].values())
+    assert "_item" in report["stats"]
+    assert report["allocations"] is None
+
+    svc.query()
+    svc.query()
+    assert len(sink.reports()) == 2
+
+
+def test_unsampled_queries_are_not_profiled():
+    sink = RingBufferSink()
+    profiler = Profiler(sink, token="secret")
+    svc = ProfiledTestService(profiler)
+    assert svc.query().status == 200
+    assert sink.reports() == []
+
+    assert not profiler.requested(None)
+    assert not profiler.requested("guess")
+    assert profiler.requested("secret")
+
+    # the header needs a token
+    assert not Profiler(sink).requested("x")
+
+
+def test_profiles_do_not_nest():
+    sink = RingBufferSink()
+    profiler = Profiler(sink, rate=1.0)
+    svc = ProfiledTestService(profiler)
+    with profiler.profile("request") as profile:
+        svc.query().serialize()
+    report, = sink.reports()
+    assert report["id"] == profile.id
+    assert sorted(report["phases"]) == ["_item", "_query", "hooks", "serialize"]
+
+
+def test_directory_sink(tmpdir):
+    path = str(tmpdir.join("profiles"))
+    svc = ProfiledTestService(Profiler(DirectorySink(path), rate=1.0))
+    svc.query()
+    names = sorted(os.listdir(path))
+    assert len(names) == 2
+    json_name, prof_name = names
+    with open(os.path.join(path, json_name)) as f:
+        assert json.load(f)["label"] == "ProfiledTestService.query"
+    pstats.Stats(os.path.join(path, prof_name))
+
+
+def test_memory_profiling_needs_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        with pytest.raises(ValueError):
+            Profiler(RingBufferSink(), memory=True)
+    else:
+        sink = RingBufferSink()
+        ProfiledTestService(Profiler(sink, rate=1.0, memory=True)).query()
+        assert sink.reports()[0]["allocations"] is not None
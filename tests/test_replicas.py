@@ -0,0 +1,136 @@
+from collection_protobuf import service
+from collection_protobuf.replicas import ReplicaPool, ReplicatedService
+from test_service import TestService, make_template
+import time
+
+
+class FakeReplica(object):
+    def __init__(self, latency=0, fail=False):
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+
+    def __call__(self, key=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        if self.fail:
+            raise IOError("replica down")
+        return iter([(key, str(self.latency))])
+
+
+def force(pool, name):
+    """
+    Make the other replicas look busy
+    """
+    for replica in pool.replicas:
+        if replica.name != name:
+            replica.outstanding += 100
+
+
+def unforce(pool):
+    for replica in pool.replicas:
+        replica.outstanding = max(0, replica.outstanding - 100)
+
+
+def test_hedged_request_wins():
+    slow = FakeReplica(latency=1.0)
+    fast = FakeReplica(latency=0)
+    pool = ReplicaPool({"slow": slow, "fast": fast})
+    pool.initial_hedge_delay = 0.01
+    force(pool, "slow")
+
+    start = time.time()
+    assert pool.query("a") == [("a", "0")]
+    assert time.time() - start < 0.5
+    assert slow.calls == 1 and fast.calls == 1
+    pool.close()
+
+
+def test_least_outstanding():
+    a, b = FakeReplica(), FakeReplica()
+    pool = ReplicaPool({"a": a, "b": b})
+    pool.replicas[0].outstanding = 1
+    pool.query("a")
+    assert (a.calls, b.calls) == (0, 1)
+    pool.close()
+
+
+def test_failing_replica_is_ejected():
+    bad, good = FakeReplica(fail=True), FakeReplica()
+    pool = ReplicaPool({"bad": bad, "good": good})
+    pool.max_failures = 2
+    for _ in range(10):
+        # failures fall over to the other replica
+        assert pool.query("a") == [("a", "0")]
+    assert bad.calls == 2
+    assert pool.replicas[0].ejected(time.time())
+    pool.close()
+
+
+def test_slow_replica_is_ejected():
+    slow, fast = FakeReplica(latency=0.02), FakeReplica(latency=0.001)
+    pool = ReplicaPool({"slow": slow, "fast": fast})
+    pool.min_samples = 3
+    pool.initial_hedge_delay = pool.min_hedge_delay = 1
+    for _ in range(3):
+        for name in ("fast", "slow"):
+            force(pool, name)
+            pool.query("a")
+            unforce(pool)
+    slow_replica, = [r for r in pool.replicas if r.name == "slow"]
+    fast_replica, = [r for r in pool.replicas if r.name == "fast"]
+    assert slow_replica.ejected(time.time())
+    assert not fast_replica.ejected(time.time())
+    pool.close()
+
+
+def test_all_replicas_fail():
+    pool = ReplicaPool({"a": FakeReplica(fail=True)})
+    try:
+        pool.query("a")
+    except IOError:
+        pass
+    else:
+        assert False, "expected IOError"
+    pool.close()
+
+
+class ReplicatedTestService(ReplicatedService, TestService):
+    pass
+
+
+def test_replicated_service():
+    svc = ReplicatedTestService()
+    svc.replicas = ReplicaPool({"a": FakeReplica()})
+    assert svc.store(make_template("k", "v", False)).status == 201
+    result = svc.query("k")
+    assert [(i.pb.key, i.pb.value) for i in result.resource.collection.items] == [("k", "0")]
+    svc.replicas.close()
+
+
+def test_deadline_reaches_the_replicas():
+    seen = []
+
+    def replica(key=None):
+        seen.append(service.current_deadline())
+        return iter([])
+
+    pool = ReplicaPool({"a": replica})
+    deadline = service.Deadline(10)
+    with service.deadline_scope(deadline):
+        pool.query()
+    assert seen == [deadline]
+    pool.close()
+
+    slow = FakeReplica(latency=0.5)
+    pool = ReplicaPool({"slow": slow})
+    start = time.time()
+    with service.deadline_scope(service.Deadline(0.05)):
+        try:
+            pool.query()
+        except service.DeadlineExceeded:
+            pass
+        else:
+            assert False, "the query outlived its deadline"
+    assert time.time() - start < 0.4
+    pool.close()
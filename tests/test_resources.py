@@ -0,0 +1,100 @@
+from collection_protobuf import service
+from collection_protobuf.resources import Pool, ResourceManager
+from test_service import TestService, make_template
+import itertools
+import pytest
+
+
+class Connection(object):
+    ids = itertools.count()
+
+    def __init__(self):
+        self.id = next(self.ids)
+        self.healthy = True
+        self.closed = False
+
+
+def make_pool(**kwargs):
+    return Pool("db", Connection,
+                health_check=lambda conn: conn.healthy,
+                close=lambda conn: setattr(conn, "closed", True),
+                **kwargs)
+
+
+def test_checkout_timeout():
+    pool = make_pool(size=1, timeout=0.01)
+    conn = pool.acquire()
+    with pytest.raises(service.Error) as e:
+        pool.acquire()
+    assert e.value.status == 503
+
+    pool.release(conn)
+    assert pool.acquire() is conn
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["saturation"] == 1.0
+    assert stats["peak_in_use"] == 1
+
+
+def test_broken_connection_is_discarded_on_error():
+    pool = make_pool(size=1)
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            conn.healthy = False
+            raise ValueError()
+    assert conn.closed
+    assert pool.acquire() is not conn
+    assert pool.stats()["discarded"] == 1
+
+
+def test_warmup():
+    pool = make_pool(size=3)
+    pool.warmup()
+    assert pool.stats()["idle"] == 3
+    pool.close()
+    assert pool.stats()["created"] == 0
+
+
+class PooledTestService(TestService):
+    def __init__(self):
+        super(PooledTestService, self).__init__()
+        self.resources = ResourceManager([make_pool(size=1, timeout=0.01)])
+        self.used = []
+
+    def _save(self, record):
+        self.used.append(self.resource("db"))
+        # the same connection for the whole call
+        assert self.resource("db") is self.used[-1]
+        if record[1] == "fail":
+            raise IOError()
+        return super(PooledTestService, self)._save(record)
+
+
+def test_service_borrows_per_call():
+    svc = PooledTestService()
+    assert svc.store(make_template("a", "1", False)).status == 201
+    assert svc.store(make_template("a", "2", False)).status == 200
+    assert svc.used[0] is svc.used[1]
+    assert svc.resources.stats()["db"]["in_use"] == 0
+
+    # returned on error
+    assert svc.store(make_template("a", "fail", False)).status == 500
+    assert svc.resources.stats()["db"]["in_use"] == 0
+    assert svc.store(make_template("b", "1", False)).status == 201
+
+    with pytest.raises(RuntimeError):
+        svc.resource("db")
+
+
+class PooledQueryTestService(PooledTestService):
+    def _query(self, key=None):
+        self.used.append(self.resource("db"))
+        return super(PooledQueryTestService, self)._query(key)
+
+
+def test_iter_items_borrows():
+    svc = PooledQueryTestService()
+    svc.store(make_template("a", "1", False))
+    items = svc.iter_items()
+    assert [item.pb.key for item in items] == ["a"]
+    assert svc.resources.stats()["db"]["in_use"] == 0
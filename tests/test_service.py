@@ -2,6 +2,7 @@ from collection_protobuf import service
 import pytest
 import test_pb2
 import logging
+import time
 logging.basicConfig(level=logging.DEBUG)
 
 
@@ -9,6 +10,7 @@ class TestService(service.Service):
     _ResourcePB = test_pb2.TestResource
 
     def __init__(self):
+        super(TestService, self).__init__()
         self.__data = {}
 
 
@@ -133,3 +135,180 @@ def make_template(key, value, null_key):
     template.pb.key = "" if null_key else key
     template.pb.value = value 
     return collection
+
+
+class ChangesTestService(TestService):
+    def __init__(self):
+        super(ChangesTestService, self).__init__()
+        self.log = []
+
+    def _changes_token(self):
+        return str(len(self.log))
+
+    def _query_changes(self, since):
+        since = int(since)
+        if since > len(self.log):
+            return None
+        changed = dict((k, v) for op, k, v in self.log[since:] if op == "save")
+        removed = [(k, "") for op, k, v in self.log[since:] if op == "delete"]
+        for key, _ in removed:
+            changed.pop(key, None)
+        return self._changes_token(), changed.iteritems(), removed
+
+    def _save(self, record):
+        self.log.append(("save",) + record)
+        return super(ChangesTestService, self)._save(record)
+
+    def _delete(self, item):
+        self.log.append(("delete", item.pb.key, None))
+        return super(ChangesTestService, self)._delete(item)
+
+
+def changes_link(result):
+    return [link.href for link in result.resource.collection.links
+            if link.rel == service.CHANGES_REL]
+
+
+def test_query_changes():
+    svc = ChangesTestService()
+    svc.store(make_template("a", "1", False))
+    svc.store(make_template("b", "2", False))
+
+    result = svc.query()
+    assert len(result.resource.collection.items) == 2
+    token, = changes_link(result)
+
+    svc.store(make_template("c", "3", False))
+    item = svc._ResourcePB().collection.items.add()
+    item.pb.key = "a"
+    svc.delete(item)
+
+    result = svc.query(since=token)
+    assert_status(result, 200)
+    items = result.resource.collection.items
+    assert [(i.pb.key, service.is_tombstone(i)) for i in items] == [
+        ("c", False), ("a", True)]
+    assert changes_link(result) == [svc._changes_token()]
+
+
+def test_query_changes_expired():
+    svc = ChangesTestService()
+    result = svc.query(since="100")
+    assert_status(result, 410)
+    assert result.resource.collection.error.code == "410"
+
+    # Services without delta support always answer 410
+    assert_status(service_obj.query(since="0"), 410)
+
+
+class SlowTestService(TestService):
+    def __init__(self, delay):
+        super(SlowTestService, self).__init__()
+        self.delay = delay
+        self.produced = 0
+
+    def _query(self, key=None):
+        for value in super(SlowTestService, self)._query(key):
+            time.sleep(self.delay)
+            self.produced += 1
+            yield value
+
+
+def test_deadline_exceeded():
+    svc = SlowTestService(0.01)
+    for key in "abcdefghij":
+        svc.store(make_template(key, key, False))
+
+    result = svc.query(deadline=service.Deadline(0.025))
+    assert_status(result, 504)
+    assert result.resource.collection.error.code == "504"
+    # The generator was closed, no more work was done
+    assert svc.produced < 10
+
+    expired = service.Deadline(0)
+    assert_status(svc.store(make_template("k", "v", False), deadline=expired), 504)
+    item = svc._ResourcePB().collection.items.add()
+    item.pb.key = "a"
+    assert_status(svc.delete(item, deadline=expired), 504)
+    assert_status(svc.query("a"), 200)
+
+
+def test_deadline_partial():
+    svc = SlowTestService(0.01)
+    svc.partial_on_deadline = True
+    for key in "abcdefghij":
+        svc.store(make_template(key, key, False))
+
+    result = svc.query(deadline=service.Deadline(0.025))
+    assert_status(result, 200)
+    assert 0 < len(result.resource.collection.items) < 10
+    assert [link.rel for link in result.resource.collection.links] == [
+        service.PARTIAL_REL]
+
+
+def test_deadline_scope():
+    seen = []
+
+    class RemainingTestService(TestService):
+        def _save(self, record):
+            seen.append(self._remaining())
+            return super(RemainingTestService, self)._save(record)
+
+    svc = RemainingTestService()
+    svc.store(make_template("a", "a", False))
+    with service.deadline_scope(service.Deadline(10)):
+        svc.store(make_template("a", "a", False))
+    assert seen[0] is None
+    assert 9 < seen[1] <= 10
+    assert service.current_deadline() is None
+
+
+class PooledTestService(TestService):
+    def __init__(self, debug=False):
+        super(PooledTestService, self).__init__()
+        self.resource_pool = service.MessagePool(
+            test_pb2.TestResource, size=2, debug=debug)
+
+
+def test_resource_pool_reuses_messages():
+    svc = PooledTestService()
+    svc.store(make_template("a", "1", False)).release()
+
+    result = svc.query()
+    resource = result.resource
+    assert len(resource.collection.items) == 1
+    result.release()
+    assert resource.ByteSize() == 0
+    with pytest.raises(service.UseAfterRelease):
+        result.resource
+
+    result = svc.query("a")
+    assert result.resource is resource
+    assert result.resource.collection.items[0].pb.value == "1"
+
+
+def test_resource_pool_debug():
+    svc = PooledTestService(debug=True)
+    result = svc.query()
+    resource = result.resource
+    result.release()
+    # a stale reference writes to the released message
+    resource.collection.href = "/stale"
+    with pytest.raises(service.UseAfterRelease):
+        svc.query()
+
+
+def test_result_slots():
+    result = service.Result(200, None)
+    with pytest.raises(AttributeError):
+        result.extra = True
+
+
+def test_item_hook_scope():
+    svc = TestService()
+    svc.store(make_template("a", "A", False))
+    svc.item_hooks.add(lambda item, record: setattr(item, "href", "/shared"))
+    with service.item_hook_scope(lambda item, record: setattr(item, "href", "/call")):
+        assert svc.query("a").resource.collection.items[0].href == "/call"
+    assert svc.query("a").resource.collection.items[0].href == "/shared"
+    assert len(svc.item_hooks.hooks) == 1
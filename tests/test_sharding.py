@@ -0,0 +1,168 @@
+from collection_protobuf import service
+from collection_protobuf.sharding import HashRing, ShardedService
+from test_service import TestService, make_template
+import test_pb2
+
+
+class TestShardedService(ShardedService):
+    _ResourcePB = test_pb2.TestResource
+
+    def _template_key(self, template):
+        if not template.pb.key:
+            raise service.Error(400, title="Missing Key")
+        return template.pb.key
+
+    def _query_key(self, key=None):
+        return key
+
+    def _delete_key(self, item):
+        return item.pb.key
+
+    def _item_sort_key(self, item):
+        return item.pb.key
+
+
+class SortedTestService(TestService):
+    def _query(self, key=None):
+        values = super(SortedTestService, self)._query(key)
+        return sorted(values) if values is not None else None
+
+
+class BrokenTestService(TestService):
+    def _query(self, key=None):
+        raise service.Error(503, title="Unavailable", code="503", message="down")
+
+
+def keys(result):
+    return [item.pb.key for item in result.resource.collection.items]
+
+
+def make_sharded(n=3):
+    return TestShardedService(
+        dict(("shard{0}".format(i), SortedTestService()) for i in range(n)))
+
+
+def test_hash_ring_is_stable():
+    ring = HashRing(["a", "b", "c"], vnodes=50)
+    bigger = HashRing(["a", "b", "c", "d"], vnodes=50)
+    keys = [str(i) for i in range(1000)]
+    moved = [k for k in keys if ring.node(k) != bigger.node(k)]
+    assert set(ring.node(k) for k in keys) == set(["a", "b", "c"])
+    # only the keys taken over by the new node move
+    assert all(bigger.node(k) == "d" for k in moved)
+
+
+def test_store_routes_by_key():
+    svc = make_sharded()
+    for key in "abcdefgh":
+        assert svc.store(make_template(key, key, False)).status == 201
+    assert svc.store(make_template("", "x", False)).status == 400
+
+    for key in "abcdefgh":
+        assert keys(svc.shard(key).query(key)) == [key]
+        assert keys(svc.query(key)) == [key]
+
+    assert sorted(keys(svc.query())) == list("abcdefgh")
+    svc.ordered = True
+    assert keys(svc.query()) == list("abcdefgh")
+
+    item = test_pb2.TestResource().collection.items.add()
+    item.pb.key = "a"
+    assert svc.delete(item).status == 204
+    assert svc.delete(item).status == 404
+    svc.close()
+
+
+def test_scatter_errors():
+    svc = make_sharded()
+    assert svc.query("a").status == 404
+    svc.store(make_template("a", "a", False))
+    assert keys(svc.query()) == ["a"]
+
+    broken = svc.shards["shard0"] = BrokenTestService()
+    broken.resource_pool = service.MessagePool(test_pb2.TestResource)
+    result = svc.query()
+    assert result.status == 503
+    assert "shard0" in result.resource.collection.error.message
+    # the failed shard result went back to its pool
+    assert len(broken.resource_pool._MessagePool__free) == 1
+    svc.close()
+
+
+class UnorderedShardedService(ShardedService):
+    _ResourcePB = test_pb2.TestResource
+
+    def _template_key(self, template):
+        return template.pb.key
+
+    def _query_key(self, key=None):
+        return key
+
+    def _delete_key(self, item):
+        return item.pb.key
+
+
+def test_unordered_needs_no_sort_key():
+    svc = UnorderedShardedService({"shard0": TestService(), "shard1": TestService()})
+    for key in "ab":
+        svc.store(make_template(key, key, False))
+    assert sorted(keys(svc.query())) == ["a", "b"]
+    svc.close()
+
+
+def test_query_options():
+    svc = make_sharded()
+    svc.ordered = True
+    for key in "abcdef":
+        svc.store(make_template(key, key, False))
+
+    assert keys(svc.query(deadline=service.Deadline(10))) == list("abcdef")
+    assert keys(svc.query("c", deadline=service.Deadline(10))) == ["c"]
+    assert keys(svc.query(nocache=True)) == list("abcdef")
+    assert svc.query(deadline=service.Deadline(0)).status == 504
+
+    result = svc.query(since="token")
+    assert result.status == 501
+    assert result.resource.collection.error.code == "501"
+
+
+def test_write_deadlines():
+    svc = make_sharded()
+    assert svc.store(make_template("a", "a", False), deadline=service.Deadline(10)).status == 201
+    template = make_template("b", "b", False)
+    assert svc.store_bytes(template.SerializeToString(),
+                           deadline=service.Deadline(10)).status == 201
+    assert svc.store(make_template("c", "c", False), deadline=service.Deadline(0)).status == 504
+
+    item = test_pb2.TestResource().collection.items.add()
+    item.pb.key = "a"
+    assert svc.delete(item, deadline=service.Deadline(0)).status == 504
+    assert svc.delete(item, deadline=service.Deadline(10)).status == 204
+    assert keys(svc.query()) == ["b"]
+    svc.close()
+
+
+class DeadlineTestService(SortedTestService):
+    def _query(self, key=None):
+        self.deadline = service.current_deadline()
+        return super(DeadlineTestService, self)._query(key)
+
+
+def test_scatter_keeps_the_current_deadline():
+    shards = dict(("shard{0}".format(i), DeadlineTestService()) for i in range(2))
+    svc = TestShardedService(shards)
+    deadline = service.Deadline(10)
+    with service.deadline_scope(deadline):
+        svc.query()
+    assert [s.deadline for s in shards.values()] == [deadline, deadline]
+    svc.close()
+
+
+def test_scatter_keeps_the_item_hook():
+    svc = make_sharded()
+    for key in "abc":
+        svc.store(make_template(key, key, False))
+    with service.item_hook_scope(lambda item, record: setattr(item, "href", "/" + record[0])):
+        result = svc.query()
+    assert sorted(item.href for item in result.resource.collection.items) == ["/a", "/b", "/c"]
+    svc.close()
@@ -0,0 +1,110 @@
+from collection_protobuf import service
+from collection_protobuf.shmcache import SharedMemoryCache, SharedMemoryCachedService
+from test_service import TestService, make_template
+import os
+import shutil
+import tempfile
+import pytest
+
+
+@pytest.fixture
+def path(request):
+    directory = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(directory))
+    return os.path.join(directory, "cache")
+
+
+def test_get_set(path):
+    cache = SharedMemoryCache(path, size=1 << 16, slot_size=256)
+    assert cache.get("a") is None
+    assert cache.set("a", "1")
+    assert cache.set("a", "2")
+    assert cache.get("a") == "2"
+    assert not cache.set("big", "x" * 256)
+    assert cache.get("big") is None
+
+    # Another process opening the same file shares the entries
+    other = SharedMemoryCache(path, size=1 << 16, slot_size=256)
+    assert other.get("a") == "2"
+    other.clear()
+    assert cache.get("a") is None
+
+
+def test_lru_eviction(path):
+    cache = SharedMemoryCache(path, size=512, slot_size=256, ways=2)
+    assert cache.sets == 1
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+
+
+def test_fork(path):
+    cache = SharedMemoryCache(path, size=1 << 16, slot_size=256)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            cache.set("child", "value")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.get("child") == "value"
+
+
+class SharedTestService(SharedMemoryCachedService, TestService):
+    pass
+
+
+def test_shared_cached_service(path):
+    svc = SharedTestService()
+    svc.shared_cache = SharedMemoryCache(path, size=1 << 16, slot_size=1024)
+    svc.store(make_template("a", "1", False))
+
+    assert not svc.query("a").cached
+    result = svc.query("a")
+    assert result.cached
+    assert result.resource.collection.items[0].pb.value == "1"
+    assert not svc.query("a", nocache=True).cached
+
+    svc.store(make_template("a", "2", False))
+    result = svc.query("a")
+    assert not result.cached
+    assert result.resource.collection.items[0].pb.value == "2"
+
+
+class RacingTestService(SharedTestService):
+    def _query(self, key=None):
+        values = list(super(RacingTestService, self)._query(key) or ())
+        # a write from another worker lands while the query runs
+        self.shared_cache.clear()
+        return values or None
+
+
+def test_write_during_query_is_not_cached(path):
+    cache = SharedMemoryCache(path, size=1 << 16, slot_size=1024)
+    generation = cache.generation()
+    cache.clear()
+    assert not cache.set("a", "1", generation)
+    assert cache.get("a") is None
+
+    svc = RacingTestService()
+    svc.shared_cache = cache
+    svc.store(make_template("a", "1", False))
+    svc.query("a")
+    assert cache.get(svc._cache_key("a")) is None
+
+
+def test_call_hook_bypasses_the_cache(path):
+    svc = SharedTestService()
+    svc.shared_cache = SharedMemoryCache(path, size=1 << 16, slot_size=1024)
+    svc.store(make_template("a", "1", False))
+    for user in ("alice", "bob"):
+        hook = lambda item, record, user=user: setattr(item, "href", "/a?user=" + user)
+        with service.item_hook_scope(hook):
+            result = svc.query("a")
+        assert not result.cached
+        assert result.resource.collection.items[0].href == "/a?user=" + user
+    assert svc.shared_cache.get(svc._cache_key("a")) is None
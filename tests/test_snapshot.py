@@ -0,0 +1,79 @@
+from collection_protobuf.snapshot import SnapshotService, publish_snapshot
+from test_service import TestService, make_template
+import os
+import test_pb2
+
+
+class KeyedTestService(TestService):
+    def _value_key(self, record):
+        return record[0]
+
+
+class SnapshotTestService(SnapshotService):
+    _ResourcePB = test_pb2.TestResource
+    snapshot_check_interval = 0
+
+
+def items(resource):
+    return [(i.href, i.pb.key, i.pb.value) for i in resource.collection.items]
+
+
+def publish(path, keys):
+    source = KeyedTestService()
+    source.item_hooks.add(lambda item, record: setattr(item, "href", "/" + record[0]))
+    for key in keys:
+        source.store(make_template(key, key.upper(), False))
+    return publish_snapshot(path, source, source._query())
+
+
+def test_query(tmpdir):
+    path = str(tmpdir.join("test.snapshot"))
+    assert publish(path, "dbeca") == 5
+    svc = SnapshotTestService()
+    svc.snapshot_path = path
+
+    result = svc.query()
+    assert result.status == 200
+    # the items are not parsed
+    assert len(result.head.collection.items) == 0
+    parsed = test_pb2.TestResource()
+    parsed.ParseFromString(result.serialize())
+    assert [key for _, key, _ in items(parsed)] == list("abcde")
+
+    assert items(svc.query("c").resource) == [("/c", "c", "C")]
+    assert items(svc.query(u"e").resource) == [("/e", "e", "E")]
+    assert svc.query("z").status == 404
+
+    assert [k for _, k, _ in items(svc.query(offset=1, limit=2).resource)] == ["b", "c"]
+    assert [k for _, k, _ in items(svc.query(offset=4, limit=2).resource)] == ["e"]
+    assert items(svc.query(offset=5).resource) == []
+
+    assert [item.pb.key for item in svc.iter_items()] == list("abcde")
+
+
+def test_read_only(tmpdir):
+    path = str(tmpdir.join("test.snapshot"))
+    publish(path, "a")
+    svc = SnapshotTestService()
+    svc.snapshot_path = path
+    assert svc.store(make_template("b", "B", False)).status == 405
+    item = test_pb2.TestResource().collection.items.add()
+    item.pb.key = "a"
+    assert svc.delete(item).status == 405
+
+
+def test_swap(tmpdir):
+    path = str(tmpdir.join("test.snapshot"))
+    svc = SnapshotTestService()
+    svc.snapshot_path = path
+    assert svc.query().status == 503
+
+    publish(path, "ab")
+    old = svc.snapshot()
+    assert [k for _, k, _ in items(svc.query().resource)] == ["a", "b"]
+
+    publish(path, "xyz")
+    assert [k for _, k, _ in items(svc.query().resource)] == ["x", "y", "z"]
+    # the swapped out snapshot is still readable
+    assert old.key(1) == "b"
+    assert [name for name in os.listdir(str(tmpdir))] == ["test.snapshot"]
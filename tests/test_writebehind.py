@@ -0,0 +1,102 @@
+from collection_protobuf import service
+from collection_protobuf.writebehind import WriteBehindService
+from test_service import TestService, make_template
+import pytest
+import threading
+
+
+class BufferedTestService(WriteBehindService, TestService):
+    write_behind_batch = 2
+    write_behind_interval = 60
+
+    def __init__(self):
+        self.batches = []
+        self.errors = []
+        self.saving = threading.Event()
+        self.saving.set()
+        super(BufferedTestService, self).__init__()
+
+    def _value_key(self, record):
+        return record[0]
+
+    def _query_key(self, key=None):
+        return key
+
+    def _save_many(self, records):
+        self.saving.wait()
+        if any(value == "fail" for key, value in records):
+            raise service.Error(500)
+        self.batches.append(records)
+        return super(BufferedTestService, self)._save_many(records)
+
+    def _flush_error(self, records, error):
+        self.errors.append(records)
+
+
+def items(result):
+    return [(i.pb.key, i.pb.value) for i in result.resource.collection.items]
+
+
+def test_store_is_buffered():
+    svc = BufferedTestService()
+    svc.saving.clear()
+    assert svc.store(make_template("a", "1", False)).status == 202
+    assert svc.store(make_template("a", "2", False)).status == 202
+    assert svc.store(make_template("", "2", False)).status == 400
+
+    # read your writes
+    assert items(svc.query("a")) == [("a", "2")]
+    assert items(svc.query()) == [("a", "2")]
+    assert svc.query("b").status == 404
+
+    svc.saving.set()
+    svc.close()
+    # coalesced into a single save
+    assert svc.batches == [[("a", "2")]]
+    assert items(svc.query("a")) == [("a", "2")]
+
+
+def test_flush_on_batch_size():
+    svc = BufferedTestService()
+    svc.store(make_template("a", "1", False))
+    svc.store(make_template("b", "1", False))
+    svc.flush()
+    assert sorted(svc.batches[0]) == [("a", "1"), ("b", "1")]
+    svc.close()
+
+
+def test_buffer_full():
+    svc = BufferedTestService()
+    svc.write_behind_size = 1
+    svc.write_behind_timeout = 0.01
+    assert svc.store(make_template("a", "1", False)).status == 202
+    # coalescing never blocks
+    assert svc.store(make_template("a", "2", False)).status == 202
+    assert svc.store(make_template("b", "1", False)).status == 503
+    svc.close()
+
+
+def test_flush_error():
+    svc = BufferedTestService()
+    svc.store(make_template("a", "fail", False))
+    svc.close()
+    assert svc.errors == [[("a", "fail")]]
+    assert svc.query("a").status == 404
+
+
+def test_delete_flushes():
+    svc = BufferedTestService()
+    svc.store(make_template("a", "1", False))
+    item = svc._ResourcePB().collection.items.add()
+    item.pb.key = "a"
+    assert svc.delete(item).status == 204
+    assert svc.query("a").status == 404
+    svc.close()
+
+
+def test_missing_hooks_fail_on_instantiation():
+    class NoKeysService(WriteBehindService, TestService):
+        pass
+
+    with pytest.raises(TypeError):
+        NoKeysService()